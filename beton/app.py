@@ -8,10 +8,14 @@ from werkzeug.contrib.fixers import ProxyFix
 
 from beton import commands
 from beton.assets import assets
-from beton.extensions import bcrypt, cache, csrf_protect, db, debug_toolbar, kvstore
-from beton.extensions import mail, migrate, moment, scheduler, security, user_datastore
+from beton.dbpool import configure_engine
+from beton.extensions import bcrypt, cache, csrf_protect, db, dblog, debug_toolbar, kvstore
+from beton.extensions import mail, migrate, moment, revive, scheduler, security, user_datastore
+from beton.revive import ReviveUnavailable
+from beton.scheduling import start_scheduler
 from beton.settings import ProdConfig
 from beton.user.forms import ExtendedConfirmRegisterForm
+from beton.user.prices import price_table
 
 
 def create_app(config_object=ProdConfig):
@@ -23,6 +27,7 @@ def create_app(config_object=ProdConfig):
     app.wsgi_app = ProxyFix(app.wsgi_app)
     app.config.from_object(config_object)
     # app.config.from_envvar('BETON')
+    configure_engine(app)
     register_extensions(app)
     register_configuration(app)
     register_blueprints(app)
@@ -40,12 +45,17 @@ def register_extensions(app):
     csrf_protect.init_app(app)
     db.app = app
     db.init_app(app)
+    dblog.init_app(app)
     debug_toolbar.init_app(app)
     mail.init_app(app)
     migrate.init_app(app, db)
     moment.init_app(app)
+    revive.init_app(app, cache)
+    price_table.init_app(app)
     scheduler.api_enabled = True
-    scheduler.init_app(app)
+    # the scheduler runs once per process, for the app which started it
+    if not scheduler.running:
+        scheduler.init_app(app)
     kvstore.init_app(app)
     security.init_app(app,
                       user_datastore,
@@ -58,19 +68,8 @@ def register_configuration(app):
     configure_uploads(app, images)
     patch_request_class(app, size=577216)
 
-    # Setting up crontabs
-    # To avoid running twice in WERKZEUG debug mode we need to make "if":
-    # https://stackoverflow.com/questions/14874782/apscheduler-in-flask-executes-twice
-    # If you are using uwsgi, leave it like it is.
-    #
-    # @app.before_first_request
-    # def load_tasks():
-    #    from beton import tasks
-    # if not app.debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
-    #   scheduler.start()
-
-    scheduler.start()
-    from beton import tasks
+    # Setting up crontabs, only in one process, see beton.scheduling
+    start_scheduler(app)
 
     return None
 
@@ -94,6 +93,11 @@ def register_errorhandlers(app):
         return render_template('{0}.html'.format(error_code)), error_code
     for errcode in [401, 404, 500]:
         app.errorhandler(errcode)(render_error)
+
+    def render_revive_unavailable(error):
+        """Fail fast while Revive is unhealthy."""
+        return render_template('503.html'), 503
+    app.errorhandler(ReviveUnavailable)(render_revive_unavailable)
     return None
 
 
@@ -115,4 +119,8 @@ def register_commands(app):
     app.cli.add_command(commands.lint)
     app.cli.add_command(commands.clean)
     app.cli.add_command(commands.urls)
+    app.cli.add_command(commands.fake_revive)
+    app.cli.add_command(commands.backfill_advertisers)
+    app.cli.add_command(commands.run_scheduler)
+    app.cli.add_command(commands.bench_queries)
     return None
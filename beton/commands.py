@@ -61,6 +61,64 @@ def clean():
                 os.remove(full_pathname)
 
 
+@click.command('fake-revive')
+@click.option('--host', default='127.0.0.1', help='Address to listen on')
+@click.option('--port', default=8999, help='Port to listen on')
+@click.option('--latency', default=0.0, help='Seconds added to every call')
+@click.option('--error-rate', default=0.0, help='Probability of a fault in every call (0-1)')
+@click.option('--publishers', default=2, help='Number of websites')
+@click.option('--zones', default=3, help='Number of zones in every website')
+@click.option('--no-multicall', default=False, is_flag=True,
+              help='Refuse system.multicall, like some Revive setups do')
+def fake_revive(host, port, latency, error_rate, publishers, zones, no_multicall):
+    """Run a local stand-in for the Revive XML-RPC API.
+
+    Log in with admin/admin and point REVIVE_XML_URI at the printed URI.
+    """
+    from beton.fakerevive import FakeReviveServer
+    server = FakeReviveServer(host=host, port=port, multicall=not no_multicall,
+                              latency=latency, error_rate=error_rate,
+                              publishers=publishers, zones=zones)
+    click.echo('Fake Revive is listening at {}'.format(server.uri))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+@click.command('backfill-advertisers')
+@with_appcontext
+def backfill_advertisers():
+    """Store Revive advertiser IDs on users which don't have them yet."""
+    from beton.user.advertisers import backfill_advertisers
+    stats = backfill_advertisers()
+    click.echo('Filled {filled} users, {missing} are not in Revive yet.'.format(**stats))
+
+
+@click.command('bench-queries')
+@click.option('--orders', default=100000, help='Number of orders to seed')
+@click.option('--users', default=1000, help='Number of users to seed')
+@click.option('--repeat', default=20, help='Runs of every query')
+@click.option('--url', default=None,
+              help='Empty database to seed, a temporary SQLite file by default')
+@with_appcontext
+def bench_queries(orders, users, repeat, url):
+    """Show plans and latencies of the hot queries on a seeded database."""
+    from beton.querybench import run
+    run(url=url, orders=orders, users=users, repeat=repeat, echo=click.echo)
+
+
+@click.command('scheduler')
+@with_appcontext
+def run_scheduler():
+    """Run the scheduled jobs in this process.
+
+    Set SCHEDULER_MODE = 'off' to keep them out of web workers.
+    """
+    from beton.scheduling import run_scheduler
+    run_scheduler(current_app._get_current_object())
+
+
 @click.command()
 @click.option('--url', default=None,
               help='Url to test (ex. /static/image.png)')
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 """Database module, including the SQLAlchemy database object and DB-related utilities."""
 
+from datetime import datetime
+
+from sqlalchemy import Integer, and_, bindparam, or_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
 from .compat import basestring
 from .extensions import db
 
-# we need to fix this problem:
-# https://stackoverflow.com/questions/27972676/flask-sqlalchemy-mysql-server-has-gone-away-when-using-haproxy
-
 # Alias common SQLAlchemy names
 Column = db.Column
 relationship = db.relationship
@@ -81,3 +84,132 @@ def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
     return db.Column(
         db.ForeignKey('{0}.{1}'.format(tablename, pk_name)),
         nullable=nullable, **kwargs)
+
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(when, key):
+    """Keyset cursor of a row sorted by a time and a unique integer key."""
+    return '{}-{}'.format(when.strftime(CURSOR_FORMAT), key)
+
+
+def decode_cursor(cursor):
+    """(time, key) of a cursor, or None if it is not a valid one."""
+    try:
+        when, key = cursor.split('-')
+        return datetime.strptime(when, CURSOR_FORMAT), int(key)
+    except (AttributeError, ValueError):
+        return None
+
+
+def before_cursor(when_column, key_column, position):
+    """Rows after `position` when sorted by time and key, both descending."""
+    when, key = position
+    return or_(when_column < when, and_(when_column == when, key_column < key))
+
+
+class DaysBetween(FunctionElement):
+    """Whole days from `start` to `end`, like `(end - start).days` in Python.
+
+    Usage: ::
+
+        db.session.query(DaysBetween(Orders.begins_at, Orders.stops_at))
+    """
+
+    type = Integer()
+    name = 'days_between'
+
+
+@compiles(DaysBetween)
+def _days_between(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'EXTRACT(DAY FROM (%s - %s))' % (compiler.process(end, **kw), compiler.process(start, **kw))
+
+
+@compiles(DaysBetween, 'sqlite')
+def _days_between_sqlite(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'CAST(julianday(%s) - julianday(%s) AS INTEGER)' % (
+        compiler.process(end, **kw), compiler.process(start, **kw))
+
+
+@compiles(DaysBetween, 'mysql')
+def _days_between_mysql(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return 'TIMESTAMPDIFF(DAY, %s, %s)' % (compiler.process(start, **kw), compiler.process(end, **kw))
+
+
+def _native_insert(dialect):
+    """Dialect specific INSERT supporting conflicts, if SQLAlchemy has it."""
+    try:
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert  # SQLAlchemy >= 1.4
+        else:
+            return None
+    except ImportError:
+        return None
+    return insert
+
+
+def upsert(model, rows, index_elements, update_columns=None):
+    """Insert rows, updating the ones which already exist.
+
+    `rows` is a list of dicts of column values, `index_elements` are columns
+    of a unique constraint telling which rows already exist. Only
+    `update_columns` (by default all other given columns) are updated.
+    The whole list is sent as one statement with ON CONFLICT on PostgreSQL
+    and SQLite, or ON DUPLICATE KEY UPDATE on MySQL. Other databases get
+    one SELECT, one bulk INSERT and one bulk UPDATE.
+    It does not commit. Usage: ::
+
+        upsert(Impressions, [{'zoneid': 1, 'impressions': 10}], ['zoneid'])
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    table = model.__table__
+    if update_columns is None:
+        update_columns = [c for c in rows[0] if c not in index_elements]
+
+    dialect = db.session.get_bind().dialect.name
+    insert = _native_insert(dialect)
+    if insert is not None:
+        stmt = insert(table).values(rows)
+        if dialect == 'mysql':
+            stmt = stmt.on_duplicate_key_update(
+                {c: stmt.inserted[c] for c in update_columns})
+        elif update_columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={c: stmt.excluded[c] for c in update_columns})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        db.session.execute(stmt)
+        return
+
+    # generic fallback
+    def key(row):
+        return tuple(row[c] for c in index_elements)
+
+    # a superset of the existing keys, for one column it is exact
+    existing = set(tuple(found) for found in db.session.query(
+        *(table.c[c] for c in index_elements)).filter(
+            *(table.c[c].in_(set(row[c] for row in rows)) for c in index_elements)))
+    new = [row for row in rows if key(row) not in existing]
+    old = [row for row in rows if key(row) in existing]
+    if new:
+        db.session.execute(table.insert(), new)
+    if old and update_columns:
+        # bind parameters must not have the same names as the columns
+        stmt = table.update().where(and_(*(
+            table.c[c] == bindparam('_' + c) for c in index_elements
+        ))).values({c: bindparam('_' + c) for c in update_columns})
+        db.session.execute(stmt, [
+            {'_' + c: row[c] for c in list(index_elements) + list(update_columns)}
+            for row in old
+        ])
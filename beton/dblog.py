@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Writer of the admin log (the log table), off the request path.
+
+`dblogger` used to insert and commit one row in the middle of a request.
+Now rows go to an in-process queue and a background thread of every
+worker process writes them in batches, with one executemany and one
+commit, when DBLOG_BATCH rows are waiting or DBLOG_INTERVAL seconds
+after the first of them. Rows still queued are written at exit.
+
+With DBLOG_ASYNC = False (used by tests) rows are written at once, in
+the session of the caller, like before.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from beton.logger import log
+
+_STOP = object()
+
+
+class LogWriter(object):
+    """Queue of log rows and the thread writing them."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DBLOG_ASYNC', True)
+        app.config.setdefault('DBLOG_BATCH', 100)
+        app.config.setdefault('DBLOG_INTERVAL', 1.0)
+        app.config.setdefault('DBLOG_QUEUE_SIZE', 10000)
+        app.extensions['dblog'] = self
+        if self.app is None:
+            atexit.register(self.close)
+        self.app = app
+
+    @property
+    def asynchronous(self):
+        return self.app is not None and self.app.config['DBLOG_ASYNC']
+
+    def write(self, user_id, logdata):
+        """Log an event of a user."""
+        row = {'user_id': user_id, 'datelog': datetime.utcnow(), 'logdata': logdata}
+        if not self.asynchronous:
+            self._write_now(row)
+            return
+        self._start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # the database is far behind, so let this request wait for it
+            self._insert([row])
+
+    def _write_now(self, row):
+        from beton.user.models import Log
+        try:
+            Log.create(**row)
+        except Exception as e:
+            log.exception(e)
+
+    def _start(self):
+        """Start the thread, again in a forked worker process."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(self.app.config['DBLOG_QUEUE_SIZE'])
+            self._thread = threading.Thread(target=self._run, name='dblog', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        batch = self.app.config['DBLOG_BATCH']
+        interval = self.app.config['DBLOG_INTERVAL']
+        rows = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP or isinstance(item, threading.Event):
+                self._insert(rows)
+                rows, deadline = [], None
+                if item is _STOP:
+                    return
+                item.set()
+                continue
+            if item is not None:
+                rows.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + interval
+            if rows and (item is None or len(rows) >= batch):
+                self._insert(rows)
+                rows, deadline = [], None
+
+    def _insert(self, rows):
+        """Write rows with one executemany; rows are lost if that fails."""
+        if not rows:
+            return
+        from beton.extensions import db
+        from beton.user.models import Log
+        try:
+            with self.app.app_context():
+                with db.engine.begin() as connection:
+                    connection.execute(Log.__table__.insert(), rows)
+            self.written += len(rows)
+        except Exception as e:
+            self.dropped += len(rows)
+            log.error('Could not write %d rows of the admin log', len(rows))
+            log.exception(e)
+
+    def flush(self, timeout=None):
+        """Wait until all rows queued so far are written."""
+        if self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=10):
+        """Write the queued rows and stop the thread."""
+        if self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._pid = None
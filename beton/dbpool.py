@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Connection pool of the SQL database, with metrics.
+
+Connections are checked with a cheap ping before use and recycled before
+MySQL (or a proxy in front of it) drops them, so requests no longer fail
+with "MySQL server has gone away". Defaults are set in `configure_engine`
+and can be changed with SQLALCHEMY_ENGINE_OPTIONS.
+
+`pool_metrics` counts how long requests wait for a connection and how
+often connections are opened, closed and invalidated; an admin sees them
+at /admin/db-pool.json, to size the pool against worker threads.
+"""
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+ENGINE_DEFAULTS = {
+    'pool_pre_ping': True,
+    'pool_recycle': 280,
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_timeout': 30
+}
+
+
+class PoolMetrics(object):
+    """Counters of one process, safe to update from many threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.checkins = 0
+            self.connects = 0
+            self.closes = 0
+            self.invalidations = 0
+            self.timeouts = 0
+            self.wait_total = 0.0
+            self.wait_max = 0.0
+
+    def waited(self, seconds, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'connects': self.connects,
+                'closes': self.closes,
+                'invalidations': self.invalidations,
+                'timeouts': self.timeouts,
+                'wait_avg_ms': 1000 * self.wait_total / self.checkouts if self.checkouts else 0.0,
+                'wait_max_ms': 1000 * self.wait_max
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool measuring how long a checkout waits for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super(TimedQueuePool, self)._do_get()
+        except Exception:
+            pool_metrics.waited(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.waited(time.perf_counter() - start)
+        return connection
+
+
+@event.listens_for(TimedQueuePool, 'connect')
+def _on_connect(dbapi_connection, connection_record):
+    pool_metrics.count('connects')
+
+
+@event.listens_for(TimedQueuePool, 'close')
+def _on_close(dbapi_connection, connection_record):
+    pool_metrics.count('closes')
+
+
+@event.listens_for(TimedQueuePool, 'invalidate')
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    pool_metrics.count('invalidations')
+
+
+@event.listens_for(TimedQueuePool, 'checkin')
+def _on_checkin(dbapi_connection, connection_record):
+    pool_metrics.count('checkins')
+
+
+def configure_engine(app):
+    """Set pool defaults, except for SQLite which has its own pools."""
+    uri = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+    if uri.startswith('sqlite'):
+        return
+    options = dict(ENGINE_DEFAULTS, poolclass=TimedQueuePool)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def pool_status():
+    """Current state of the pool and the counters of this process."""
+    from beton.extensions import db
+    pool = db.engine.pool
+    status = {'pool': pool.__class__.__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    status.update(pool_metrics.snapshot())
+    return status
@@ -17,16 +17,21 @@ from flask_wtf.csrf import CSRFProtect
 from flask_security import Security, SQLAlchemyUserDatastore
 from flask_sqlalchemy import SQLAlchemy
 
+from beton.dblog import LogWriter
+from beton.revive import Revive
+
 app_dir = os.path.abspath(os.path.dirname(__file__))
 
 bcrypt = Bcrypt()
 cache = Cache()
 csrf_protect = CSRFProtect()
 db = SQLAlchemy()
+dblog = LogWriter()
 debug_toolbar = DebugToolbarExtension()
 mail = Mail()
 migrate = Migrate()
 moment = Moment()
+revive = Revive()
 scheduler = APScheduler()
 sesstore = FilesystemStore(app_dir + '/data')
 kvstore = KVSessionExtension(sesstore)
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the Revive XML-RPC API.
+
+It implements the ox.* methods Beton uses, keeping all data in memory, so
+the Revive-bound paths can be tested and benchmarked without a real Revive.
+Every call can be slowed down and made to fail on purpose: ::
+
+    server = FakeReviveServer(latency=0.05, error_rate=0.1).start()
+    app.config['REVIVE_XML_URI'] = server.uri
+    ...
+    server.stop()
+
+It is also available as `flask fake-revive`.
+"""
+
+import random
+import socketserver
+import threading
+import time
+import uuid
+import xmlrpc.client
+
+from datetime import datetime
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+from beton.logger import log
+
+
+class FakeRevive(object):
+    """In-memory state and ox.* methods of the fake Revive."""
+
+    def __init__(self, username='admin', password='admin', latency=0, error_rate=0,
+                 failing_methods=(), publishers=2, zones=3, seed=None):
+        self.username = username
+        self.password = password
+        # seconds added to every call, or a dict of them per method
+        self.latency = latency
+        # probability of a random fault in every call
+        self.error_rate = error_rate
+        # methods which always fail
+        self.failing_methods = set(failing_methods)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.sessions = set()
+        self.advertisers = {}
+        self.publishers = {}
+        self.zones = {}
+        self.campaigns = {}
+        self.banners = {}
+        self.links = set()
+        self.stats = []
+        self._ids = {}
+        for publisher in range(publishers):
+            publisher_id = self.add_publisher('website{}.example.com'.format(publisher + 1))
+            for zone in range(zones):
+                self.add_zone(publisher_id, 'zone {}'.format(zone + 1),
+                              width=(468, 728, 300)[zone % 3], height=(60, 90, 250)[zone % 3])
+
+    # Helpers for tests and benchmarks
+
+    def _next_id(self, kind):
+        self._ids[kind] = self._ids.get(kind, 0) + 1
+        return self._ids[kind]
+
+    def add_publisher(self, name, agency_id=1):
+        publisher_id = self._next_id('publisher')
+        self.publishers[publisher_id] = {
+            'publisherId': publisher_id,
+            'agencyId': agency_id,
+            'publisherName': name,
+            'website': 'https://' + name
+        }
+        return publisher_id
+
+    def add_zone(self, publisher_id, name, width=468, height=60, type=0, comments=''):
+        zone_id = self._next_id('zone')
+        self.zones[zone_id] = {
+            'zoneId': zone_id,
+            'publisherId': publisher_id,
+            'zoneName': name,
+            'type': type,
+            'width': width,
+            'height': height,
+            'comments': comments
+        }
+        return zone_id
+
+    def add_traffic(self, campaign_id, impressions, clicks=0, when=None):
+        """Record impressions and clicks of a campaign in its linked zones."""
+        when = when or datetime.utcnow()
+        zones = [zone_id for (zone_id, linked) in self.links if linked == campaign_id] or [0]
+        for zone_id in zones:
+            self.stats.append((when, campaign_id, zone_id, impressions, clicks))
+
+    def expire_sessions(self):
+        """Forget all sessions, like Revive does after a timeout."""
+        self.sessions.clear()
+
+    # XML-RPC plumbing
+
+    def _dispatch(self, method, params):
+        with self.lock:
+            self.calls.append(method)
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(method, 0)
+        if latency:
+            time.sleep(latency)
+        if method in self.failing_methods or self.random.random() < self.error_rate:
+            raise xmlrpc.client.Fault(1, 'Injected error in {}'.format(method))
+        if not method.startswith('ox.'):
+            raise xmlrpc.client.Fault(1, 'Method {} does not exist'.format(method))
+        name = method[3:]
+        func = getattr(self, name, None)
+        if func is None or name.startswith('_'):
+            raise xmlrpc.client.Fault(1, 'Method {} does not exist'.format(method))
+        if name != 'logon':
+            sessionid = params[0] if params else None
+            if sessionid not in self.sessions:
+                raise xmlrpc.client.Fault(1, 'Session ID is invalid')
+            params = params[1:]
+        with self.lock:
+            return func(*params)
+
+    def _get(self, table, key, what):
+        try:
+            return table[key]
+        except KeyError:
+            raise xmlrpc.client.Fault(1, 'Unknown {}Id Error'.format(what))
+
+    @staticmethod
+    def _in_window(when, start, end):
+        return start <= when and when <= end
+
+    # ox.* methods
+
+    def logon(self, username, password):
+        if (username, password) != (self.username, self.password):
+            raise xmlrpc.client.Fault(1, 'Username or password is incorrect')
+        sessionid = 'phpads' + uuid.uuid4().hex
+        self.sessions.add(sessionid)
+        return sessionid
+
+    def logoff(self):
+        return True
+
+    def getUserList(self):
+        return [{'userId': 1, 'userName': self.username, 'contactName': self.username}]
+
+    def getAgency(self, agency_id):
+        return {'agencyId': agency_id, 'agencyName': 'Default manager'}
+
+    def getAdvertiserListByAgencyId(self, agency_id):
+        return [a for a in self.advertisers.values() if a['agencyId'] == agency_id]
+
+    def getPublisherListByAgencyId(self, agency_id):
+        return [p for p in self.publishers.values() if p['agencyId'] == agency_id]
+
+    def getZoneListByPublisherId(self, publisher_id):
+        self._get(self.publishers, publisher_id, 'publisher')
+        return [z for z in self.zones.values() if z['publisherId'] == publisher_id]
+
+    def getCampaignListByAdvertiserId(self, advertiser_id):
+        return [c for c in self.campaigns.values() if c['advertiserId'] == advertiser_id]
+
+    def getBannerListByCampaignId(self, campaign_id):
+        return [b for b in self.banners.values() if b['campaignId'] == campaign_id]
+
+    def addAdvertiser(self, data):
+        advertiser_id = self._next_id('advertiser')
+        self.advertisers[advertiser_id] = dict(data, advertiserId=advertiser_id)
+        return advertiser_id
+
+    def addCampaign(self, data):
+        self._get(self.advertisers, data.get('advertiserId'), 'advertiser')
+        campaign_id = self._next_id('campaign')
+        self.campaigns[campaign_id] = dict(data, campaignId=campaign_id)
+        return campaign_id
+
+    def addBanner(self, data):
+        self._get(self.campaigns, data.get('campaignId'), 'campaign')
+        banner_id = self._next_id('banner')
+        self.banners[banner_id] = dict(data, bannerId=banner_id)
+        return banner_id
+
+    def linkCampaign(self, zone_id, campaign_id):
+        self._get(self.zones, zone_id, 'zone')
+        self._get(self.campaigns, campaign_id, 'campaign')
+        self.links.add((zone_id, campaign_id))
+        return True
+
+    def deleteCampaign(self, campaign_id):
+        self._get(self.campaigns, campaign_id, 'campaign')
+        del self.campaigns[campaign_id]
+        self.links = set(link for link in self.links if link[1] != campaign_id)
+        for banner_id in [b for b, banner in self.banners.items() if banner['campaignId'] == campaign_id]:
+            del self.banners[banner_id]
+        return True
+
+    def campaignBannerStatistics(self, campaign_id, start, end):
+        self._get(self.campaigns, campaign_id, 'campaign')
+        impressions = clicks = 0
+        for when, campaign, zone, imp, clk in self.stats:
+            if campaign == campaign_id and self._in_window(when, start, end):
+                impressions += imp
+                clicks += clk
+        return [{
+            'bannerId': banner['bannerId'],
+            'bannerName': banner.get('bannerName', ''),
+            'requests': impressions,
+            'impressions': impressions,
+            'clicks': clicks,
+            'revenue': 0
+        } for banner in self.getBannerListByCampaignId(campaign_id)]
+
+    def campaignDailyStatistics(self, campaign_id, start, end):
+        self._get(self.campaigns, campaign_id, 'campaign')
+        days = {}
+        for when, campaign, zone, imp, clk in self.stats:
+            if campaign == campaign_id and self._in_window(when, start, end):
+                day = datetime(when.year, when.month, when.day)
+                impressions, clicks = days.get(day, (0, 0))
+                days[day] = (impressions + imp, clicks + clk)
+        return [{
+            'day': day,
+            'requests': impressions,
+            'impressions': impressions,
+            'clicks': clicks,
+            'revenue': 0
+        } for day, (impressions, clicks) in sorted(days.items())]
+
+    def agencyZoneStatistics(self, agency_id, start, end):
+        totals = {}
+        for when, campaign, zone, imp, clk in self.stats:
+            if zone in self.zones and self._in_window(when, start, end):
+                impressions, clicks = totals.get(zone, (0, 0))
+                totals[zone] = (impressions + imp, clicks + clk)
+        rows = []
+        for zone_id, (impressions, clicks) in sorted(totals.items()):
+            zone = self.zones[zone_id]
+            rows.append({
+                'publisherId': zone['publisherId'],
+                'publisherName': self.publishers[zone['publisherId']]['publisherName'],
+                'zoneId': zone_id,
+                'zoneName': zone['zoneName'],
+                'requests': impressions,
+                'impressions': impressions,
+                'clicks': clicks,
+                'revenue': 0
+            })
+        return rows
+
+
+class _KeepAliveHandler(SimpleXMLRPCRequestHandler):
+    """Keep connections open between requests, like a real web server."""
+
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingServer(socketserver.ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class FakeReviveServer(object):
+    """Serves a FakeRevive over HTTP in a background thread."""
+
+    def __init__(self, host='127.0.0.1', port=0, multicall=True, **kwargs):
+        self.revive = FakeRevive(**kwargs)
+        self.server = _ThreadingServer((host, port), requestHandler=_KeepAliveHandler,
+                                       logRequests=False, allow_none=True,
+                                       use_builtin_types=True)
+        self.server.register_instance(self.revive)
+        if multicall:
+            self.server.register_function(self._multicall, 'system.multicall')
+        self.thread = None
+
+    def _multicall(self, calls):
+        with self.revive.lock:
+            self.revive.calls.append('system.multicall')
+        return self.server.system_multicall(calls)
+
+    @property
+    def uri(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}/www/api/v2/xmlrpc/index.php'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        log.debug("Fake Revive listening at %s" % self.uri)
+        return self
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -4,20 +4,20 @@ import pprint
 import pushover
 import requests
 import uuid
-import xmlrpc
 
 from datetime import datetime
 from oslo_concurrency import lockutils
 
-from flask import Blueprint, current_app, flash, redirect, render_template, request, send_from_directory, url_for
+from flask import Blueprint, current_app, flash, jsonify, redirect, render_template
+from flask import request, send_from_directory, url_for
 from flask_api import status
 from flask_mail import Message
 from flask_security import current_user, login_required, logout_user
 
 from beton.logger import log
-from beton.extensions import csrf_protect, mail
+from beton.extensions import csrf_protect, mail, revive
 from beton.user.models import Orders, Payments, User, db
-from beton.utils import dblogger, reviveme
+from beton.utils import bump_data_version, dblogger
 
 blueprint = Blueprint('public', __name__, static_folder='../static')
 
@@ -46,6 +46,15 @@ def about():
     return render_template('public/about.html')
 
 
+@blueprint.route('/health/revive')
+def revive_health():
+    """State of the connection to Revive, for monitoring."""
+    health = revive.health()
+    if health['state'] == 'open':
+        return jsonify(health), status.HTTP_503_SERVICE_UNAVAILABLE
+    return jsonify(health), status.HTTP_200_OK
+
+
 # TODO: this should be served directly via nginx in production
 @blueprint.route('/banners/<path:filename>')
 def download_file(filename):
@@ -99,20 +108,18 @@ def ipn():
             posdata=ipn['data']['posData']).update(
                 {"confirmed_at": datetime.utcnow()})
         Payments.commit()
+        bump_data_version('orders')
 
-        # Log in into Revive
-        r = xmlrpc.client.ServerProxy(
-            current_app.config.get('REVIVE_XML_URI'),
-            verbose=False
-        )
-        sessionid = reviveme(r)
         # Loading all orders related to payment
         all_orders = Orders.query.filter_by(paymentno=pay_db.id).all()
         log.debug("We are having these orders in the basket:")
         log.debug(all_orders)
-        # We are now linking Revive
-        for order in all_orders:
-            linkme = r.ox.linkCampaign(sessionid, order.zoneid, order.campaigno)
+        # We are now linking Revive, all orders in one request
+        all_links = revive.batch(
+            ('ox.linkCampaign', (order.zoneid, order.campaigno))
+            for order in all_orders
+        )
+        for order, linkme in zip(all_orders, all_links):
             log.debug("Have we linked camapign {} into zone {} in Revive? {}".format(
                 order.campaigno,
                 order.zoneid,
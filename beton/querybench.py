@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Query plans and latencies of the hot queries on a seeded database.
+
+It is used by `flask bench-queries`. The database is seeded from the
+models, so it has the same tables and indexes as production. Every query
+is measured with all indexes and again after the non-unique ones are
+dropped. ::
+
+    flask bench-queries --orders 1000000
+"""
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, select, text
+
+from beton.extensions import db
+
+CHUNK = 10000
+
+
+def _insert(engine, table, rows):
+    """Insert a generator of rows in chunks, with executemany."""
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            engine.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        engine.execute(table.insert(), chunk)
+
+
+def seed(engine, orders=100000, users=1000, zones=50, seed=1):
+    """Fill an empty database with random but plausible data."""
+    rnd = random.Random(seed)
+    tables = db.metadata.tables
+    db.metadata.create_all(engine)
+    now = datetime.utcnow()
+    payments = orders // 2
+
+    _insert(engine, tables['users'], ({
+        'id': user,
+        'username': 'user{}'.format(user),
+        'email': 'user{}@example.com'.format(user),
+        'password': '',
+        'active': True
+    } for user in range(1, users + 1)))
+    _insert(engine, tables['banners'], ({
+        'id': banner,
+        'filename': 'banner{}.png'.format(banner),
+        'owner': rnd.randint(1, users),
+        'created_at': now,
+        'url': 'https://example.com/',
+        'width': 468,
+        'height': 60,
+        'type': 'image'
+    } for banner in range(1, users * 5 + 1)))
+
+    def payment(number):
+        created_at = now - timedelta(days=rnd.randint(0, 1500))
+        paid = rnd.random() < 0.9
+        return {
+            'id': number,
+            'created_at': created_at,
+            'received_at': created_at if paid else datetime.min,
+            'confirmed_at': created_at if paid else datetime.min,
+            'btcpayserver_id': 'x{}'.format(number),
+            'posdata': '{:036d}'.format(number),
+            'fiat': 'EUR',
+            'fiat_amount': 10,
+            'user_id': rnd.randint(1, users)
+        }
+    _insert(engine, tables['payments'], (payment(number) for number in range(1, payments + 1)))
+
+    def order(number):
+        begins_at = now - timedelta(days=rnd.randint(0, 1500))
+        return {
+            'id': number,
+            'campaigno': number,
+            'zoneid': rnd.randint(1, zones),
+            'created_at': begins_at,
+            'begins_at': begins_at,
+            'stops_at': begins_at + timedelta(days=rnd.randint(1, 30)),
+            'paymentno': rnd.randint(1, payments),
+            'bannerid': rnd.randint(1, users * 5),
+            'name': 'campaign',
+            'comments': '',
+            'impressions': 0,
+            'user_id': rnd.randint(1, users)
+        }
+    _insert(engine, tables['orders'], (order(number) for number in range(1, orders + 1)))
+    _insert(engine, tables['basket'], ({
+        'user_id': rnd.randint(1, users),
+        'campaigno': rnd.randint(1, orders)
+    } for _ in range(users * 3)))
+    _insert(engine, tables['log'], ({
+        'user_id': rnd.randint(1, users),
+        'datelog': now - timedelta(minutes=rnd.randint(0, 1500 * 24 * 60)),
+        'logdata': 'Something happened.'
+    } for _ in range(orders)))
+
+
+def hot_queries(users=1000, payments=50000):
+    """The queries run by views and jobs, with typical arguments."""
+    t = db.metadata.tables
+    now = datetime.utcnow()
+    user = users // 2
+    return [
+        ('campaign() of a user (page)',
+         select([t['orders']]).where(t['orders'].c.user_id == user).where(
+             t['orders'].c.stops_at > now - timedelta(weeks=4)).order_by(
+                 t['orders'].c.stops_at.desc(), t['orders'].c.campaigno.desc()).limit(51)),
+        ('running campaigns (stats job)',
+         select([t['orders'].c.id]).where(t['orders'].c.stops_at >= now)),
+        ('bookings of a zone (availability)',
+         select([t['orders'].c.begins_at, t['orders'].c.stops_at]).where(
+             t['orders'].c.zoneid == 1).where(t['orders'].c.stops_at >= now).where(
+                 t['orders'].c.begins_at < now + timedelta(days=90))),
+        ('orders of a payment (ipn, cleanup)',
+         select([t['orders']]).where(t['orders'].c.paymentno == payments // 2)),
+        ('payment by posdata (ipn)',
+         select([t['payments']]).where(t['payments'].c.posdata == '{:036d}'.format(payments // 2))),
+        ('stale unpaid payments (cleanup)',
+         select([t['payments'].c.id]).where(t['payments'].c.received_at == datetime.min).where(
+             t['payments'].c.created_at < now - timedelta(days=7)).order_by(
+                 t['payments'].c.id).limit(500)),
+        ('basket of a user',
+         select([t['basket']]).where(t['basket'].c.user_id == user)),
+        ('log of a user (page)',
+         select([t['log']]).where(t['log'].c.user_id == user).order_by(
+             t['log'].c.datelog.desc(), t['log'].c.id.desc()).limit(51)),
+        ('banners of a user',
+         select([t['banners']]).where(t['banners'].c.owner == user)),
+    ]
+
+
+def explain(engine, query):
+    """Query plan as one string."""
+    sql = str(query.compile(engine, compile_kwargs={'literal_binds': True}))
+    prefix = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+    return ' | '.join(' '.join(str(v) for v in row) for row in engine.execute(text(prefix + sql)))
+
+
+def measure(engine, query, repeat=20):
+    """Median latency of a query in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        engine.execute(query).fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def drop_indexes(engine):
+    """Drop all non-unique indexes, to compare with a bare schema."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if not index.unique:
+                index.drop(engine)
+
+
+def run(url=None, orders=100000, users=1000, repeat=20, echo=print):
+    """Seed a database and report plans and latencies of the hot queries."""
+    path = None
+    if url is None:
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        url = 'sqlite:///' + path
+    engine = create_engine(url)
+    try:
+        echo('Seeding {} orders into {} ...'.format(orders, url))
+        start = time.perf_counter()
+        seed(engine, orders=orders, users=users)
+        echo('Seeded in {:.1f}s.'.format(time.perf_counter() - start))
+
+        queries = hot_queries(users=users, payments=orders // 2)
+        results = {}
+        for phase in ('indexed', 'bare'):
+            if phase == 'bare':
+                drop_indexes(engine)
+            for name, query in queries:
+                results.setdefault(name, {})[phase] = (measure(engine, query, repeat),
+                                                       explain(engine, query))
+        for name, _ in queries:
+            echo('')
+            echo(name)
+            for phase in ('bare', 'indexed'):
+                latency, plan = results[name][phase]
+                echo('  {:8} {:10.3f} ms  {}'.format(phase, latency, plan))
+    finally:
+        engine.dispose()
+        if path is not None:
+            os.remove(path)
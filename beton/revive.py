@@ -0,0 +1,622 @@
+# -*- coding: utf-8 -*-
+"""Revive XML-RPC client.
+
+All revive XML RPC commands:
+https://github.com/revive-adserver/revive-adserver/blob/master/www/api/v2/xmlrpc/index.php
+
+Every worker keeps a small pool of persistent HTTP/1.1 connections to Revive,
+so views and cron jobs do not pay a TCP+TLS handshake for every call.
+
+All callers share one admin session, which is refreshed only when Revive
+answers with a fault or when it gets older than REVIVE_SESSION_TTL.
+
+Independent calls can be batched into one system.multicall round-trip,
+or fanned out over a bounded number of threads.
+
+Calls have timeouts, reads are retried, and a circuit breaker makes calls
+fail fast (serving the last known reads) while Revive is unhealthy.
+"""
+
+import os
+import queue
+import random
+import threading
+import time
+import xmlrpc.client
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from beton.logger import log
+
+
+class ReviveUnavailable(Exception):
+    """Revive is considered unhealthy, so calls fail fast."""
+
+
+class PoolExhausted(RuntimeError):
+    """No pooled connection got free in time."""
+
+
+class _TimeoutMixin(object):
+    """Keep one persistent connection with an adjustable timeout."""
+
+    def make_connection(self, host):
+        conn = super(_TimeoutMixin, self).make_connection(host)
+        conn.timeout = self.timeout
+        return conn
+
+    def set_timeout(self, timeout):
+        """Change the timeout, also of an already open connection."""
+        self.timeout = timeout
+        conn = self._connection[1]
+        if conn is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+
+
+class PooledTransport(_TimeoutMixin, xmlrpc.client.Transport):
+    """A keep-alive transport with a timeout."""
+
+    def __init__(self, timeout=None, **kwargs):
+        super(PooledTransport, self).__init__(**kwargs)
+        self.timeout = timeout
+
+
+class PooledSafeTransport(_TimeoutMixin, xmlrpc.client.SafeTransport):
+    """The same as PooledTransport, but over TLS."""
+
+    def __init__(self, timeout=None, **kwargs):
+        super(PooledSafeTransport, self).__init__(**kwargs)
+        self.timeout = timeout
+
+
+class CircuitBreaker(object):
+    """Stop calling Revive for a while after several failures in a row.
+
+    After `reset_timeout` seconds one trial call is let through; its success
+    closes the breaker again, its failure keeps it open.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial = False
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def release_trial(self):
+        """Let another call try, the trial call never reached Revive."""
+        with self._lock:
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    log.info("Revive circuit breaker opened after %d failures." % self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def status(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'opened_at': self.opened_at,
+            'trips': self.trips
+        }
+
+
+class RetryBudget(object):
+    """Retries may add at most `ratio` of extra calls to Revive.
+
+    Every call earns `ratio` of a token and every retry spends one, so a
+    struggling Revive is not flooded with retries from all callers.
+    """
+
+    def __init__(self, ratio=0.2, minimum=5):
+        self.ratio = ratio
+        self.maximum = max(minimum, 10)
+        self.tokens = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.maximum, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+def is_idempotent(method):
+    """Reads can be safely repeated, writes not."""
+    name = method.rsplit('.', 1)[-1]
+    return name.startswith('get') or name.endswith('Statistics') or name == 'logon'
+
+
+def is_session_fault(fault):
+    """Revive refused our session ID, e.g. after it timed out."""
+    return isinstance(fault, xmlrpc.client.Fault) and 'session' in str(fault.faultString).lower()
+
+
+class TransportPool(object):
+    """A bounded, per-process pool of keep-alive transports to one URI."""
+
+    def __init__(self, uri, size=4, timeout=None, wait=None):
+        self.uri = uri
+        self.size = size
+        self.timeout = timeout
+        self.wait = wait
+        self._secure = urlsplit(uri).scheme == 'https'
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _new_transport(self):
+        if self._secure:
+            return PooledSafeTransport(timeout=self.timeout)
+        return PooledTransport(timeout=self.timeout)
+
+    def acquire(self):
+        """Get an idle transport, create one or wait for one to be released."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                return self._new_transport()
+        try:
+            return self._idle.get(timeout=self.wait)
+        except queue.Empty:
+            raise PoolExhausted(
+                "No free connection to Revive in the pool after %s seconds." % self.wait)
+
+    def release(self, transport, broken=False):
+        """Put a transport back, or drop it if its connection is unusable."""
+        if broken:
+            transport.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(transport)
+
+    def close(self):
+        """Close all idle connections."""
+        while True:
+            try:
+                transport = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            transport.close()
+            with self._lock:
+                self._created -= 1
+
+
+class _Method(object):
+    """Dotted XML-RPC method name, called through the pool."""
+
+    def __init__(self, client, name):
+        self._client = client
+        self._name = name
+
+    def __getattr__(self, name):
+        return _Method(self._client, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args):
+        return self._client.call(self._name, *args)
+
+
+class _SessionMethod(_Method):
+    """Dotted XML-RPC method name, called with the shared admin session."""
+
+    def __getattr__(self, name):
+        return _SessionMethod(self._client, '%s.%s' % (self._name, name))
+
+    def __call__(self, *args):
+        return self._client.session_call(self._name, *args)
+
+
+class ReviveProxy(object):
+    """Drop-in replacement of `xmlrpc.client.ServerProxy` backed by a pool.
+
+    Usage: ::
+
+        r = revive.proxy()
+        r.ox.getZoneListByPublisherId(sessionid, publisher_id)
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return _Method(self._client, name)
+
+    def __repr__(self):
+        return '<ReviveProxy {}>'.format(self._client.uri)
+
+
+class Revive(object):
+    """Flask extension holding the Revive connection pool of a worker.
+
+    Methods called through `revive.ox` get the shared admin session
+    prepended to their arguments: ::
+
+        revive.ox.getZoneListByPublisherId(publisher_id)
+    """
+
+    SESSION_KEY = 'revive_sessionid'
+
+    def __init__(self, app=None, cache=None):
+        self.app = None
+        self.uri = None
+        self.cache = None
+        self._lock = threading.Lock()
+        self._session_lock = threading.Lock()
+        self._reset()
+        if app is not None:
+            self.init_app(app, cache)
+
+    def _reset(self):
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+        self._stale = OrderedDict()
+        self._pool = None
+        self._executor = None
+        self._pid = None
+        self._session = None
+        self._session_expires = 0
+        self._multicall_enabled = True
+
+    def init_app(self, app, cache=None):
+        self.app = app
+        # forget connections and the session of a previous app
+        self._reset()
+        app.config.setdefault('REVIVE_POOL_SIZE', 4)
+        app.config.setdefault('REVIVE_TIMEOUT', 30)
+        app.config.setdefault('REVIVE_POOL_WAIT', 10)
+        app.config.setdefault('REVIVE_SESSION_TTL', 1800)
+        # seconds to wait for answers of particular methods, if different
+        app.config.setdefault('REVIVE_TIMEOUTS', {})
+        # network errors of reads are retried with a jittered backoff
+        app.config.setdefault('REVIVE_RETRIES', 2)
+        app.config.setdefault('REVIVE_RETRY_BACKOFF', 0.2)
+        # after that many failures in a row calls fail fast for a while
+        app.config.setdefault('REVIVE_BREAKER_THRESHOLD', 5)
+        app.config.setdefault('REVIVE_BREAKER_RESET', 30)
+        # last good results of reads, served while Revive is down
+        app.config.setdefault('REVIVE_STALE_ENTRIES', 256)
+        # keep the session in the app cache, so all workers share it
+        # (useful only with a shared CACHE_TYPE like redis or memcached)
+        app.config.setdefault('REVIVE_SESSION_SHARED', False)
+        # the most calls sent in one system.multicall request
+        app.config.setdefault('REVIVE_MULTICALL', True)
+        app.config.setdefault('REVIVE_MULTICALL_SIZE', 50)
+        # the most calls a worker sends to Revive at the same time
+        app.config.setdefault('REVIVE_MAX_CONCURRENCY', 4)
+        self.uri = app.config.get('REVIVE_XML_URI')
+        self.breaker = CircuitBreaker(app.config.get('REVIVE_BREAKER_THRESHOLD'),
+                                      app.config.get('REVIVE_BREAKER_RESET'))
+        if app.config.get('REVIVE_SESSION_SHARED'):
+            self.cache = cache
+        app.extensions['revive'] = self
+
+    @property
+    def ox(self):
+        return _SessionMethod(self, 'ox')
+
+    @property
+    def pool(self):
+        """The pool of the current process.
+
+        It is created lazily, so workers forked by uwsgi/gunicorn never share
+        sockets inherited from the master process.
+        """
+        self._check_pid()
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    config = self.app.config
+                    self._pool = TransportPool(
+                        self.uri,
+                        size=config.get('REVIVE_POOL_SIZE'),
+                        timeout=config.get('REVIVE_TIMEOUT'),
+                        wait=config.get('REVIVE_POOL_WAIT')
+                    )
+        return self._pool
+
+    @property
+    def executor(self):
+        """Threads of the current process used for concurrent calls.
+
+        Its size is the limit of calls this worker sends to Revive at once.
+        """
+        self._check_pid()
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.app.config.get('REVIVE_MAX_CONCURRENCY'),
+                        thread_name_prefix='revive'
+                    )
+        return self._executor
+
+    def _check_pid(self):
+        """Forget the pool and threads inherited from a parent process."""
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._pool = None
+                    self._executor = None
+                    self._pid = pid
+
+    def proxy(self):
+        return ReviveProxy(self)
+
+    def _send(self, method, send, timeout):
+        """Run `send(server)` with a ServerProxy over a pooled connection."""
+        pool = self.pool
+        transport = pool.acquire()
+        transport.set_timeout(timeout)
+        broken = False
+        try:
+            server = xmlrpc.client.ServerProxy(self.uri, transport=transport)
+            return send(server)
+        except xmlrpc.client.Fault:
+            # Revive answered, the connection is fine
+            raise
+        except Exception:
+            broken = True
+            log.debug("Dropping Revive connection after failed %s call." % method)
+            raise
+        finally:
+            pool.release(transport, broken=broken)
+
+    def _request(self, method, send, idempotent=False, timeout=None):
+        """Send a request through the circuit breaker.
+
+        Reads failing on the network level are repeated with a jittered
+        exponential backoff, within REVIVE_RETRIES and the retry budget.
+        """
+        config = self.app.config
+        if timeout is None:
+            timeout = config.get('REVIVE_TIMEOUTS').get(method, config.get('REVIVE_TIMEOUT'))
+        retries = config.get('REVIVE_RETRIES') if idempotent else 0
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise ReviveUnavailable("Revive is unhealthy, not calling %s." % method)
+            try:
+                result = self._send(method, send, timeout)
+            except xmlrpc.client.Fault:
+                self.breaker.success()
+                raise
+            except PoolExhausted:
+                # our pool is busy, which says nothing about Revive
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                self.breaker.failure()
+                if attempt >= retries or not self.budget.withdraw():
+                    raise
+                attempt += 1
+                delay = random.uniform(0, config.get('REVIVE_RETRY_BACKOFF') * 2 ** attempt)
+                log.debug("Retrying %s in %.2fs after: %s" % (method, delay, e))
+                time.sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+
+    def call(self, method, *args, timeout=None):
+        """Call a Revive XML-RPC method over a pooled connection."""
+        return self._request(method, lambda server: getattr(server, method)(*args),
+                             idempotent=is_idempotent(method), timeout=timeout)
+
+    def _multicall(self, sessionid, calls):
+        """Send calls in one system.multicall request.
+
+        Returns a list of results, with Fault instances for failed calls.
+        """
+        def send(server):
+            multicall = xmlrpc.client.MultiCall(server)
+            for method, args in calls:
+                getattr(multicall, method)(sessionid, *args)
+            return multicall().results
+
+        config = self.app.config
+        # Revive runs the calls one after another, so slow ones add up
+        slow = config.get('REVIVE_TIMEOUTS')
+        timeout = max(config.get('REVIVE_TIMEOUT'),
+                      sum(slow[method] for method, args in calls if method in slow))
+        idempotent = all(is_idempotent(method) for method, args in calls)
+        results = []
+        for item in self._request('system.multicall', send, idempotent=idempotent, timeout=timeout):
+            if isinstance(item, dict):
+                results.append(xmlrpc.client.Fault(item['faultCode'], item['faultString']))
+            else:
+                results.append(item[0])
+        return results
+
+    def _parallel(self, sessionid, calls, return_exceptions=True):
+        """Send calls one by one, but from several threads at once.
+
+        Results keep the order of `calls`. At most REVIVE_MAX_CONCURRENCY
+        calls of this worker run at the same time.
+        """
+        def send(call):
+            method, args = call
+            try:
+                return self.call(method, sessionid, *args)
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                return e
+
+        return list(self.executor.map(send, calls))
+
+    def batch(self, calls, return_exceptions=False):
+        """Run many session calls at once, in order.
+
+        `calls` is a list of `(method, args)` tuples, for example: ::
+
+            revive.batch([('ox.deleteCampaign', (campaigno,)) for ...])
+
+        Calls are sent as one system.multicall request. If Revive has
+        multicall turned off, or REVIVE_MULTICALL is False, they are sent
+        as concurrent individual calls instead.
+        With `return_exceptions` failed calls give their exception instead
+        of raising the first one.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        chunk = self.app.config.get('REVIVE_MULTICALL_SIZE')
+        results = []
+        for start in range(0, len(calls), chunk):
+            results.extend(self._batch(calls[start:start + chunk]))
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def _batch(self, calls):
+        for attempt in range(2):
+            sessionid = self.sessionid(refresh=attempt > 0)
+            if self._multicall_enabled and self.app.config.get('REVIVE_MULTICALL'):
+                try:
+                    results = self._multicall(sessionid, calls)
+                except xmlrpc.client.Fault as e:
+                    log.info("Revive refused system.multicall, using parallel calls: %s" % e.faultString)
+                    self._multicall_enabled = False
+                    results = self._parallel(sessionid, calls)
+            else:
+                results = self._parallel(sessionid, calls)
+            # only when our session expired no call has run, so all may be repeated
+            if not all(is_session_fault(result) for result in results):
+                break
+        return results
+
+    def logon(self):
+        """Open a new admin session in Revive."""
+        return self.call('ox.logon',
+                         self.app.config.get('REVIVE_MASTER_USER'),
+                         self.app.config.get('REVIVE_MASTER_PASSWORD'))
+
+    def sessionid(self, refresh=False):
+        """Get the shared admin session, logging in only when needed."""
+        ttl = self.app.config.get('REVIVE_SESSION_TTL')
+        with self._session_lock:
+            now = time.time()
+            if not refresh and self._session and now < self._session_expires:
+                return self._session
+            if not refresh and self.cache is not None:
+                shared = self.cache.get(self.SESSION_KEY)
+                if shared and shared != self._session:
+                    self._session = shared
+                    self._session_expires = now + ttl
+                    return self._session
+            log.debug("Logging in into Revive.")
+            self._session = self.logon()
+            self._session_expires = now + ttl
+            if self.cache is not None:
+                self.cache.set(self.SESSION_KEY, self._session, timeout=ttl)
+            return self._session
+
+    def session_call(self, method, *args):
+        """Call a method with the admin session as its first argument.
+
+        After a fault the session is renewed and the call repeated once,
+        as an expired session is the most common reason of faults.
+        When Revive is unreachable, reads give their last known result.
+        """
+        try:
+            result = self._session_call(method, *args)
+        except xmlrpc.client.Fault:
+            raise
+        except Exception as e:
+            if is_idempotent(method):
+                stale = self._stale.get((method, repr(args)))
+                if stale is not None:
+                    log.info("Serving cached %s as Revive failed: %s" % (method, e))
+                    return stale
+            raise
+        if is_idempotent(method):
+            self._remember((method, repr(args)), result)
+        return result
+
+    def _session_call(self, method, *args):
+        sessionid = self.sessionid()
+        try:
+            return self.call(method, sessionid, *args)
+        except xmlrpc.client.Fault as e:
+            # other faults are answers of Revive, and the call may have
+            # changed something already, so it is not repeated
+            if not is_session_fault(e):
+                raise
+            log.debug("Revive fault in %s, renewing session: %s" % (method, e.faultString))
+            with self._session_lock:
+                if self._session == sessionid:
+                    self._session_expires = 0
+            return self.call(method, self.sessionid(), *args)
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._stale[key] = result
+            self._stale.move_to_end(key)
+            while len(self._stale) > self.app.config.get('REVIVE_STALE_ENTRIES'):
+                self._stale.popitem(last=False)
+
+    def health(self):
+        """State of the connection to Revive, for monitoring."""
+        status = self.breaker.status()
+        pool = self._pool
+        status.update({
+            'retry_tokens': round(self.budget.tokens, 2),
+            'stale_entries': len(self._stale),
+            'multicall': self._multicall_enabled,
+            'pool_size': pool.size if pool else 0,
+            'pool_open': pool._created if pool else 0,
+            'pool_idle': pool._idle.qsize() if pool else 0,
+        })
+        return status
+
+    def keepalive(self):
+        """Cheap call keeping both the session and a connection warm."""
+        return self.ox.getAgency(self.app.config.get('REVIVE_AGENCY_ID'))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""Running the scheduled jobs from beton.tasks in exactly one process.
+
+Every web worker creates the app, but only the one holding a lock file
+starts the scheduler. The others keep trying to get the lock in the
+background, so a new leader takes over when the old one exits or dies
+(the operating system releases the lock of a dead process).
+
+SCHEDULER_MODE selects the behaviour:
+
+- ``'leader'`` (default): one of the web workers runs the jobs,
+- ``'off'``: web workers never run them, use ``flask scheduler``
+  as a dedicated process instead,
+- ``'always'``: every process runs them, like before.
+
+Jobs wrapped with `monitored` store every run in the job_runs table,
+see `job_status` for the summary shown to admins.
+"""
+import fcntl
+import functools
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+from flask_apscheduler.utils import job_to_dict
+from sqlalchemy import func
+
+from beton.extensions import db, scheduler
+from beton.logger import log
+from beton.user.models import JobRun
+
+# How long the history of job runs is kept
+JOB_RUNS_KEEP = timedelta(days=30)
+
+
+class LeaderLock(object):
+    """Exclusive lock on a file, held for the whole life of the process."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def acquire(self, blocking=False):
+        """Take the lock; without `blocking` give up at once if it is taken."""
+        if self.held:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lockfile = open(self.path, 'a+')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            lockfile.close()
+            return False
+        # for humans only, the lock itself is the flock
+        lockfile.seek(0)
+        lockfile.truncate()
+        lockfile.write('{}\n'.format(os.getpid()))
+        lockfile.flush()
+        self._file = lockfile
+        return True
+
+    def release(self):
+        if self.held:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def _lock(app):
+    app.config.setdefault('SCHEDULER_LOCK_FILE',
+                          os.path.join(app.root_path, 'data', 'scheduler.lock'))
+    if 'scheduler_lock' not in app.extensions:
+        app.extensions['scheduler_lock'] = LeaderLock(app.config['SCHEDULER_LOCK_FILE'])
+    return app.extensions['scheduler_lock']
+
+
+def _follow(lock, retry):
+    """Wait in the background until this process can become the leader."""
+    while not scheduler.running:
+        time.sleep(retry)
+        if lock.acquire():
+            log.info("Scheduler: pid %d became the leader." % os.getpid())
+            scheduler.start()
+            return
+
+
+def start_scheduler(app):
+    """Start the scheduler if this process should run the jobs.
+
+    Returns True if it has been started right away.
+    """
+    app.config.setdefault('SCHEDULER_MODE', 'leader')
+    app.config.setdefault('SCHEDULER_LOCK_RETRY', 60)
+    mode = app.config['SCHEDULER_MODE']
+    if mode == 'off' or scheduler.running:
+        return False
+
+    from beton import tasks  # noqa: F401, registers the jobs
+
+    if mode == 'always':
+        scheduler.start()
+        return True
+
+    lock = _lock(app)
+    if lock.acquire():
+        log.info("Scheduler: pid %d is the leader." % os.getpid())
+        scheduler.start()
+        return True
+    threading.Thread(target=_follow, args=(lock, app.config['SCHEDULER_LOCK_RETRY']),
+                     name='scheduler-follower', daemon=True).start()
+    return False
+
+
+def run_scheduler(app):
+    """Run the jobs in this process until it is interrupted.
+
+    If another process is the leader, wait for it to go away first.
+    """
+    from beton import tasks  # noqa: F401, registers the jobs
+
+    if not scheduler.running:
+        lock = _lock(app)
+        if not lock.acquire():
+            log.info("Scheduler: waiting for the current leader to exit.")
+            lock.acquire(blocking=True)
+        scheduler.start()
+    log.info("Scheduler: running jobs in pid %d." % os.getpid())
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        scheduler.shutdown()
+        _lock(app).release()
+
+
+def monitored(job):
+    """Run a job in the app context and record how it went.
+
+    The job may return a dict of counts; 'failed' is stored as errors and
+    all other numbers are summed as processed items. An exception is logged
+    and stored as one error. ::
+
+        @scheduler.task('interval', id='x', hours=1, max_instances=1, coalesce=True)
+        @monitored
+        def x():
+            return {'updated': 10, 'failed': 1}
+    """
+    @functools.wraps(job)
+    def wrapper(*args, **kwargs):
+        # called by hand (a command, a test) it uses the current app
+        app = current_app._get_current_object() if has_app_context() else scheduler.app
+        with app.app_context():
+            started_at = datetime.utcnow()
+            start = time.monotonic()
+            items = errors = 0
+            try:
+                stats = job(*args, **kwargs) or {}
+                errors = stats.get('failed', 0)
+                items = sum(value for key, value in stats.items()
+                            if key != 'failed' and isinstance(value, int))
+                details = str(stats)
+            except Exception as e:
+                log.debug("Exception")
+                log.exception(e)
+                db.session.rollback()
+                errors = 1
+                details = repr(e)
+            duration = time.monotonic() - start
+            log.info("Job %s finished in %.2fs: %s" % (job.__name__, duration, details))
+            try:
+                JobRun.query.filter(JobRun.started_at < started_at - JOB_RUNS_KEEP).delete(
+                    synchronize_session=False)
+                JobRun.create(job_id=job.__name__, started_at=started_at, duration=duration,
+                              items=items, errors=errors, details=details)
+            except Exception as e:
+                log.exception(e)
+                db.session.rollback()
+    return wrapper
+
+
+def job_status(last=10):
+    """Scheduled jobs with their statistics and `last` recent runs."""
+    jobs = {}
+    # only the leader has the jobs scheduled, other processes see the history
+    for job in scheduler.get_jobs():
+        jobs[job.func.__name__] = {'job': job_to_dict(job)}
+    since = datetime.utcnow() - timedelta(days=1)
+    for job_id, runs, errors, items, avg, longest in db.session.query(
+            JobRun.job_id, func.count(JobRun.id), func.sum(JobRun.errors),
+            func.sum(JobRun.items), func.avg(JobRun.duration), func.max(JobRun.duration)
+    ).filter(JobRun.started_at >= since).group_by(JobRun.job_id):
+        jobs.setdefault(job_id, {})['last_day'] = {
+            'runs': runs,
+            'errors': int(errors or 0),
+            'items': int(items or 0),
+            'avg_duration': float(avg or 0),
+            'max_duration': float(longest or 0)
+        }
+    for job_id, status in jobs.items():
+        status.setdefault('job', None)
+        status.setdefault('last_day', None)
+        status['runs'] = [{
+            'started_at': run.started_at,
+            'duration': run.duration,
+            'items': run.items,
+            'errors': run.errors,
+            'details': run.details
+        } for run in JobRun.query.filter_by(job_id=job_id).order_by(
+            JobRun.started_at.desc()).limit(last)]
+    return jobs
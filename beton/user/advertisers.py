@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Revive advertisers of our users.
+
+Every user is one advertiser in Revive. Its ID is stored on the User row
+the first time it is needed, so we don't have to look it up again.
+"""
+from flask import current_app
+
+from beton.extensions import db, revive
+from beton.logger import log
+from beton.user.models import User
+
+
+def revive_advertisers():
+    """Advertiser IDs registered in Revive, by their names."""
+    all_advertisers = revive.ox.getAdvertiserListByAgencyId(
+        current_app.config.get('REVIVE_AGENCY_ID')
+    )
+    return {x['advertiserName']: int(x['advertiserId']) for x in all_advertisers}
+
+
+def provision_advertiser(user):
+    '''Find out if the user is already registered in Revive,
+       if not, register him. The ID is saved on the user.'''
+    if user.revive_advertiser_id is not None:
+        return user.revive_advertiser_id
+
+    advertiser_id = revive_advertisers().get(user.username)
+    if advertiser_id is None:
+        advertiser_id = int(revive.ox.addAdvertiser(
+            {
+                'agencyId': current_app.config.get('REVIVE_AGENCY_ID'),
+                'advertiserName': user.username,
+                'emailAddress': user.email,
+                'contactName': user.username,
+                'comments': current_app.config.get('USER_APP_NAME')
+            }
+        ))
+        log.info("Added {} as new advertiser.".format(user.username))
+
+    user.revive_advertiser_id = advertiser_id
+    db.session.commit()
+    return advertiser_id
+
+
+def backfill_advertisers():
+    """Store Revive advertiser IDs of all users which don't have it yet.
+
+    Users not registered in Revive are left alone, they will be registered
+    on their first order. Returns numbers of filled and missing users.
+    """
+    advertisers = revive_advertisers()
+    stats = {'filled': 0, 'missing': 0}
+    for user in User.query.filter(User.revive_advertiser_id.is_(None)):
+        advertiser_id = advertisers.get(user.username)
+        if advertiser_id is None:
+            stats['missing'] += 1
+            continue
+        user.revive_advertiser_id = advertiser_id
+        stats['filled'] += 1
+    db.session.commit()
+    return stats
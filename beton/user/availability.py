@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Which days of a zone are still free for booking.
+
+A zone is sold by whole days, to one campaign at a time. A campaign takes
+every day from its begins_at to its stops_at, both included, see
+`campaign_days`, which the price is computed from too. Orders waiting in
+a basket hold their days, until they are paid, or removed as unpaid by
+the cleanup job together with abandoned baskets.
+
+Bookings of a zone in a window are found with a range scan of the
+(zoneid, stops_at) index, which skips the past of the zone, or of the
+covering (zoneid, begins_at, stops_at) one, whichever range the database
+finds narrower, so the cost does not grow with the order history.
+"""
+from datetime import datetime, timedelta
+
+from beton.extensions import db
+from beton.user.models import Orders, Prices
+
+
+def _day(value):
+    return datetime.combine(value.date(), datetime.min.time())
+
+
+def campaign_days(begins_at, stops_at):
+    """Number of days a campaign takes and is paid for, both ends included.
+
+    basket_items computes the same in SQL, with DaysBetween + 1.
+    """
+    return (_day(stops_at) - _day(begins_at)).days + 1
+
+
+def _taking(zone_id, start, end):
+    """Criteria of campaigns in a zone taking any day from start to end."""
+    return (Orders.zoneid == zone_id,
+            Orders.stops_at >= _day(start),
+            Orders.begins_at < _day(end) + timedelta(days=1))
+
+
+def bookings(zone_id, start, end):
+    """(begins_at, stops_at) of campaigns in a zone taking days from start to end."""
+    return db.session.query(Orders.begins_at, Orders.stops_at).filter(
+        *_taking(zone_id, start, end)).order_by(Orders.begins_at).all()
+
+
+def booked_days(zone_id, start, end):
+    """Sorted days from start to end which are already taken in a zone."""
+    first, last = _day(start), _day(end)
+    days = set()
+    for begins_at, stops_at in bookings(zone_id, first, last):
+        day = max(_day(begins_at), first)
+        while day <= min(_day(stops_at), last):
+            days.add(day)
+            day += timedelta(days=1)
+    return sorted(days)
+
+
+def free_days(zone_id, start, end):
+    """Sorted days from start to end which can still be booked in a zone."""
+    first, last = _day(start), _day(end)
+    taken = set(booked_days(zone_id, first, last))
+    return [first + timedelta(days=offset)
+            for offset in range((last - first).days + 1)
+            if first + timedelta(days=offset) not in taken]
+
+
+def is_free(zone_id, start, end):
+    """True if no campaign in the zone takes any day from start to end."""
+    return not db.session.query(
+        db.session.query(Orders.id).filter(*_taking(zone_id, start, end)).exists()).scalar()
+
+
+def book(zone_id, start, end, **order):
+    '''Create an order of a zone from start to end if its days are still free.
+
+    Bookings of one zone are serialised with a lock on its price row, so
+    two orders can not both pass the check. It commits what is pending in
+    the session first, so the check sees orders committed meanwhile.
+    Returns the new order, or None if some of the days are taken.
+    '''
+    db.session.commit()
+    Prices.query.filter_by(zoneid=zone_id).with_for_update().first()
+    if not is_free(zone_id, start, end):
+        db.session.rollback()
+        return None
+    return Orders.create(zoneid=zone_id, begins_at=start, stops_at=end, **order)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Campaigns with their payments and banners, for listing.
+
+Rows are plain namedtuples of the selected columns, never ORM entities,
+and lists are read a page at a time with a keyset cursor on
+(stops_at, campaigno), newest first, so a request holds at most one page
+however many campaigns there are.
+"""
+import json
+from collections import namedtuple
+from datetime import datetime
+from decimal import Decimal
+
+from beton.database import before_cursor, decode_cursor, encode_cursor
+from beton.extensions import db
+from beton.user.models import Banner, Orders, Payments
+
+COLUMNS = (
+    Orders.user_id,
+    Orders.begins_at,
+    Orders.stops_at,
+    Orders.created_at,
+    Orders.zoneid,
+    Orders.campaigno,
+    Orders.bannerid,
+    Orders.name,
+    Orders.comments,
+    Orders.impressions,
+    Payments.posdata,
+    Payments.btcpayserver_id,
+    Payments.received_at,
+    Payments.confirmed_at,
+    Payments.fiat_amount,
+    Payments.fiat,
+    Banner.filename,
+    Banner.url,
+    Banner.width,
+    Banner.height,
+    Banner.content,
+    Banner.icon,
+    Banner.type
+)
+
+CampaignRow = namedtuple('CampaignRow', [column.key for column in COLUMNS])
+
+
+def campaign_query():
+    """Orders joined with their payments and banners."""
+    return db.session.query(*COLUMNS).select_from(Orders).join(
+        Payments, Orders.paymentno == Payments.id).join(
+            Banner, Orders.bannerid == Banner.id)
+
+
+def campaign_row(query):
+    """The first row of a query as a CampaignRow, or None."""
+    row = query.first()
+    return CampaignRow(*row) if row else None
+
+
+def campaign_page(since, user_id=None, cursor=None, size=50):
+    '''Campaigns ending after `since`, latest end first.
+
+    Only campaigns of `user_id` are listed, or of all users if it is None.
+    Returns the rows and the cursor of the next page, None on the last one.
+    '''
+    query = campaign_query().filter(Orders.stops_at > since)
+    if user_id is not None:
+        query = query.filter(Orders.user_id == user_id)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(before_cursor(Orders.stops_at, Orders.campaigno, position))
+    rows = [CampaignRow(*row) for row in query.order_by(
+        Orders.stops_at.desc(), Orders.campaigno.desc()).limit(size + 1)]
+    if len(rows) > size:
+        return rows[:size], encode_cursor(rows[size - 1].stops_at, rows[size - 1].campaigno)
+    return rows, None
+
+
+def _json_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(repr(value))
+
+
+def campaigns_json(since, user_id=None, chunk=500):
+    '''All campaigns of `campaign_page` as a JSON array, in pieces.
+
+    Campaigns are read `chunk` at a time, so the whole list is never in
+    memory.
+    '''
+    yield '['
+    cursor = None
+    first = True
+    while True:
+        rows, cursor = campaign_page(since, user_id, cursor, chunk)
+        for row in rows:
+            yield ('' if first else ',') + json.dumps(row._asdict(), default=_json_value)
+            first = False
+        if cursor is None:
+            break
+    yield ']'
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Removal of orders which were never paid."""
+from datetime import datetime, timedelta
+
+from beton.extensions import db, revive
+from beton.logger import log
+from beton.user.models import Basket, Log, Orders, Payments
+from beton.utils import bump_data_version
+
+
+def _remove_campaigns(campaigns, now):
+    """Remove campaigns from Revive in a batch, returns their log rows."""
+    logs = []
+    all_removed = revive.batch(
+        (('ox.deleteCampaign', (campaign.campaigno,)) for campaign in campaigns),
+        return_exceptions=True
+    )
+    for campaign, removed in zip(campaigns, all_removed):
+        if isinstance(removed, Exception):
+            log.info(
+                "WARNING! Campaign %s was not removed from Revive - it has not existed over there. It may be an error." % (
+                    campaign.campaigno
+                )
+            )
+        logs.append({
+            'user_id': campaign.user_id,
+            'datelog': now,
+            'logdata': ("Removed campaign #%d for zone %d with banner %d, " +
+                        "created at %s, starting from %s and ending at %s.") % (
+                campaign.campaigno,
+                campaign.zoneid,
+                campaign.bannerid,
+                str(campaign.created_at),
+                str(campaign.begins_at),
+                str(campaign.stops_at)
+            )
+        })
+    return logs
+
+
+def _campaigns():
+    return db.session.query(
+        Orders.campaigno, Orders.zoneid, Orders.bannerid, Orders.user_id,
+        Orders.created_at, Orders.begins_at, Orders.stops_at
+    )
+
+
+def remove_unpaid(timeperiod=7, chunk=500):
+    '''Remove payments not received for `timeperiod` days, with their orders.
+
+    Stale payments are found with an index and processed `chunk` at a time,
+    so neither memory nor the number of queries depends on the size of the
+    whole payment history. Campaigns are removed from Revive in batches.
+    Orders left in a basket for `timeperiod` days are removed the same way,
+    as they hold their days in the zone.
+    Returns numbers of removed payments and campaigns.
+    '''
+    cutoff = datetime.utcnow() - timedelta(days=timeperiod)
+    stats = {'payments': 0, 'campaigns': 0}
+    last_id = 0
+    while True:
+        payments = db.session.query(
+            Payments.id, Payments.user_id, Payments.btcpayserver_id
+        ).filter(
+            Payments.received_at == datetime.min,
+            Payments.created_at < cutoff,
+            Payments.id > last_id
+        ).order_by(Payments.id).limit(chunk).all()
+        if not payments:
+            break
+        last_id = payments[-1].id
+        payment_ids = [payment.id for payment in payments]
+        now = datetime.utcnow()
+
+        logs = [{
+            'user_id': payment.user_id,
+            'datelog': now,
+            'logdata': 'CRON: Removed unpaid payment ID {btcpayid}.'.format(
+                btcpayid=payment.btcpayserver_id
+            )
+        } for payment in payments]
+
+        campaigns = _campaigns().filter(Orders.paymentno.in_(payment_ids)).all()
+        logs.extend(_remove_campaigns(campaigns, now))
+
+        Orders.query.filter(Orders.paymentno.in_(payment_ids)).delete(synchronize_session=False)
+        Payments.query.filter(Payments.id.in_(payment_ids)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(Log, logs)
+        db.session.commit()
+        bump_data_version('orders')
+        log.debug("Removed unpaid payments: %s" % payment_ids)
+        stats['payments'] += len(payments)
+        stats['campaigns'] += len(campaigns)
+
+    # orders of abandoned baskets have no payment yet
+    while True:
+        campaigns = _campaigns().filter(
+            Orders.paymentno == 0,
+            Orders.created_at < cutoff
+        ).order_by(Orders.campaigno).limit(chunk).all()
+        if not campaigns:
+            return stats
+        campaign_ids = [campaign.campaigno for campaign in campaigns]
+        logs = _remove_campaigns(campaigns, datetime.utcnow())
+
+        Basket.query.filter(Basket.campaigno.in_(campaign_ids)).delete(synchronize_session=False)
+        Orders.query.filter(Orders.campaigno.in_(campaign_ids)).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(Log, logs)
+        db.session.commit()
+        bump_data_version('orders')
+        log.debug("Removed abandoned basket campaigns: %s" % campaign_ids)
+        stats['campaigns'] += len(campaigns)
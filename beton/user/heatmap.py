@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Occupancy and booked revenue of zones by day, for admins.
+
+Paid campaigns of the window are loaded as plain columns and turned into
+NumPy arrays. Every campaign adds +1 to its zone at its first day and -1
+after its last day, and a cumulative sum along the days gives how many
+campaigns run in each zone on each day, so the cost is one pass over the
+campaigns and one over the zone x day grid.
+
+Revenue is counted with the current day price of a zone, orders do not
+keep the price they were paid for. Results are cached under the version
+stamp of orders, kept in the database and bumped by every worker which
+adds, removes or confirms orders, so no worker serves an outdated map.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from beton.extensions import cache, db
+from beton.user.models import Orders, Payments, Prices, Zone
+from beton.utils import data_version
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+
+def _days(values):
+    """Days since the epoch of a sequence of datetimes, as an int array."""
+    return (np.array(values, dtype='datetime64[D]') - EPOCH).astype(np.int64)
+
+
+def heatmap(start, end):
+    '''Zone x day occupancy and booked revenue from start to end, both included.
+
+    Returns a dict of the days, the zones with their names, day prices,
+    fill rates and revenues, and `occupancy`, a list of rows of campaign
+    counts, one row per zone and one column per day.
+    '''
+    key = 'heatmap:{}:{:%Y%m%d}:{:%Y%m%d}'.format(data_version('orders'), start, end)
+    result = cache.get(key)
+    if result is None:
+        result = _heatmap(start, end)
+        cache.set(key, result, timeout=24 * 3600)
+    return result
+
+
+def _heatmap(start, end):
+    first = datetime.combine(start.date(), datetime.min.time())
+    last = datetime.combine(end.date(), datetime.min.time())
+    ndays = (last - first).days + 1
+
+    zones = db.session.query(Prices.zoneid, Prices.dayprice, Zone.name).outerjoin(
+        Zone, Zone.zoneid == Prices.zoneid).order_by(Prices.zoneid).all()
+    zone_ids = np.array([zone.zoneid for zone in zones], dtype=np.int64)
+    dayprices = np.array([zone.dayprice for zone in zones], dtype=np.int64)
+
+    campaigns = db.session.query(Orders.zoneid, Orders.begins_at, Orders.stops_at).join(
+        Payments, Orders.paymentno == Payments.id).filter(
+            Payments.confirmed_at != datetime.min,
+            Orders.stops_at >= first,
+            Orders.begins_at < last + timedelta(days=1)).all()
+
+    occupancy = np.zeros((len(zones), ndays), dtype=np.int64)
+    if campaigns and len(zones):
+        zoneids, begins, stops = zip(*campaigns)
+        zoneids = np.array(zoneids, dtype=np.int64)
+        rows = np.searchsorted(zone_ids, zoneids)
+        # campaigns of zones without a price are left out
+        known = (rows < len(zone_ids)) & (zone_ids[np.minimum(rows, len(zone_ids) - 1)] == zoneids)
+        offset = _days([first])[0]
+        begins = np.clip(_days(begins) - offset, 0, ndays - 1)
+        stops = np.clip(_days(stops) - offset, 0, ndays - 1)
+        steps = np.zeros((len(zones), ndays + 1), dtype=np.int64)
+        np.add.at(steps, (rows[known], begins[known]), 1)
+        np.add.at(steps, (rows[known], stops[known] + 1), -1)
+        occupancy = np.cumsum(steps[:, :ndays], axis=1)
+
+    booked = occupancy > 0
+    revenue = occupancy.sum(axis=1) * dayprices
+    return {
+        'start': first.strftime("%Y-%m-%d"),
+        'end': last.strftime("%Y-%m-%d"),
+        'days': [(first + timedelta(days=day)).strftime("%Y-%m-%d") for day in range(ndays)],
+        'zones': [{
+            'zoneid': zone.zoneid,
+            'name': zone.name,
+            'dayprice': zone.dayprice,
+            'fill_rate': float(booked[row].mean()) if ndays else 0.0,
+            'revenue': int(revenue[row])
+        } for row, zone in enumerate(zones)],
+        'occupancy': occupancy.tolist(),
+        'fill_rate': float(booked.mean()) if booked.size else 0.0,
+        'revenue': int(revenue.sum())
+    }
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Local mirror of Revive publishers and zones.
+
+Publishers and zones hardly ever change, so we keep a copy of them in SQL
+and views never need to ask Revive about them.
+"""
+from datetime import datetime
+
+from flask import current_app
+
+from beton.extensions import db, revive
+from beton.logger import log
+from beton.user.models import Prices, Publisher, Zone
+from beton.user.prices import price_table, prices_changed
+
+ZONE_FIELDS = {
+    'publisherid': 'publisherId',
+    'name': 'zoneName',
+    'width': 'width',
+    'height': 'height',
+    'type': 'type',
+    'comments': 'comments'
+}
+
+
+def sync_inventory():
+    """Bring the mirror up to date with Revive.
+
+    Only changed rows are written. Every new zone gets a zero price, which
+    admins can change later on the offer page.
+    Returns a dict with numbers of added, updated and removed rows.
+    """
+    now = datetime.utcnow()
+    stats = {'added': 0, 'updated': 0, 'removed': 0}
+
+    publishers = revive.ox.getPublisherListByAgencyId(
+        current_app.config.get('REVIVE_AGENCY_ID')
+    )
+    zonelists = revive.batch(
+        ('ox.getZoneListByPublisherId', (website['publisherId'],))
+        for website in publishers
+    )
+
+    # publishers
+    known = {p.publisherid: p for p in Publisher.query.all()}
+    for website in publishers:
+        publisher = known.pop(website['publisherId'], None)
+        if publisher is None:
+            db.session.add(Publisher(
+                publisherid=website['publisherId'],
+                name=website['publisherName'],
+                synced_at=now
+            ))
+            stats['added'] += 1
+        elif publisher.name != website['publisherName']:
+            publisher.name = website['publisherName']
+            publisher.synced_at = now
+            stats['updated'] += 1
+    # flush new publishers before zones referring to them
+    db.session.flush()
+
+    # zones
+    known_zones = {z.zoneid: z for z in Zone.query.all()}
+    priced = set(zoneid for (zoneid,) in db.session.query(Prices.zoneid))
+    new_prices = False
+    for allzones in zonelists:
+        for revivezone in allzones:
+            zoneid = revivezone['zoneId']
+            values = {column: revivezone.get(field) for column, field in ZONE_FIELDS.items()}
+            zone = known_zones.pop(zoneid, None)
+            if zone is None:
+                db.session.add(Zone(zoneid=zoneid, synced_at=now, **values))
+                stats['added'] += 1
+            elif any(getattr(zone, column) != value for column, value in values.items()):
+                for column, value in values.items():
+                    setattr(zone, column, value)
+                zone.synced_at = now
+                stats['updated'] += 1
+            if zoneid not in priced:
+                db.session.add(Prices(zoneid=zoneid, dayprice=0, x0=0, x1=0, y0=0, y1=0))
+                priced.add(zoneid)
+                new_prices = True
+
+    # whatever is left was removed from Revive
+    for zone in known_zones.values():
+        db.session.delete(zone)
+        stats['removed'] += 1
+    for publisher in known.values():
+        db.session.delete(publisher)
+        stats['removed'] += 1
+
+    db.session.commit()
+    if new_prices:
+        prices_changed()
+    log.debug("Inventory synced with Revive: %s" % stats)
+    return stats
+
+
+def ignored_websites():
+    return current_app.config.get('REVIVE_IGNORED_WEBSITES') or []
+
+
+def ensure_inventory():
+    """Fill the mirror if it is empty, it happens only on the very first run."""
+    if Publisher.query.first() is None:
+        sync_inventory()
+
+
+def get_publishers():
+    """All mirrored publishers except these on our blacklist."""
+    ensure_inventory()
+    return Publisher.query.filter(
+        ~Publisher.name.in_(ignored_websites())
+    ).order_by(Publisher.publisherid).all()
+
+
+def get_zones(width=None, height=None, all_sizes=False):
+    """Zones of websites in our offer, with their prices.
+
+    Returns a list of (Zone, ZonePrice) tuples, the price is None for a zone
+    without one. Only zones of the given banner size are listed, which is an
+    indexed query, so a banner without a size gets none; pass `all_sizes`
+    to list every zone. Prices come from the in-process price table.
+    """
+    ensure_inventory()
+    query = Zone.query.join(
+        Publisher, Zone.publisherid == Publisher.publisherid).filter(
+            ~Publisher.name.in_(ignored_websites()))
+    if not all_sizes:
+        query = query.filter(Zone.width == width, Zone.height == height)
+    prices = price_table.all()
+    return [(zone, prices.get(zone.zoneid))
+            for zone in query.order_by(Zone.publisherid, Zone.zoneid)]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Reading and archiving the admin log.
+
+Log rows of a user are read newest first, a page at a time, with a keyset
+cursor on (datelog, id) which follows the (user_id, datelog, id) index, so
+every page costs the same however deep it is. Rows older than
+LOG_RETENTION_DAYS are moved to the log_archive table by a cron job.
+"""
+import csv
+import io
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from beton.database import before_cursor, decode_cursor, encode_cursor
+from beton.extensions import db
+from beton.user.models import Log, LogArchive
+
+
+def log_page(user_id, cursor=None, size=50):
+    '''One page of log rows of a user, newest first.
+
+    Returns the rows and the cursor of the next (older) page, which is None
+    on the last page.
+    '''
+    query = db.session.query(Log.id, Log.datelog, Log.logdata).filter(Log.user_id == user_id)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(before_cursor(Log.datelog, Log.id, position))
+    rows = query.order_by(Log.datelog.desc(), Log.id.desc()).limit(size + 1).all()
+    if len(rows) > size:
+        return rows[:size], encode_cursor(rows[size - 1].datelog, rows[size - 1].id)
+    return rows, None
+
+
+def export_csv(user_id, chunk=1000):
+    '''All log rows of a user as CSV lines, newest first.
+
+    Rows are read `chunk` at a time, so a long log is streamed without
+    being held in memory.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(*values):
+        writer.writerow(values)
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line('id', 'datelog', 'logdata')
+    cursor = None
+    while True:
+        rows, cursor = log_page(user_id, cursor, chunk)
+        for row in rows:
+            yield line(row.id, row.datelog.isoformat(), row.logdata)
+        if cursor is None:
+            return
+
+
+def archive_logs(days=365, chunk=1000):
+    '''Move log rows older than `days` to log_archive, `chunk` at a time.
+
+    Every chunk is copied and deleted in its own transaction, so the job
+    never holds long locks on the log table. Returns the number of moved rows.
+    '''
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    table = Log.__table__
+    columns = [table.c.id, table.c.user_id, table.c.datelog, table.c.logdata]
+    moved = 0
+    while True:
+        ids = [log_id for log_id, in db.session.query(Log.id).filter(
+            Log.datelog < cutoff).order_by(Log.id).limit(chunk)]
+        if not ids:
+            return moved
+        db.session.execute(LogArchive.__table__.insert().from_select(
+            [column.name for column in columns],
+            select(columns).where(table.c.id.in_(ids))))
+        Log.query.filter(Log.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        moved += len(ids)
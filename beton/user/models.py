@@ -33,6 +33,8 @@ class User(UserMixin, SurrogatePK, Model):
     password = db.Column(db.String(255), nullable=False, default='')
     active = Column(db.Boolean(), default=True)
     confirmed_at = Column(db.DateTime, nullable=True)
+    # filled on the first order, see beton.user.advertisers
+    revive_advertiser_id = Column(db.Integer(), unique=True, nullable=True)
 
     def get_security_payload(self):
         '''Custom User Payload'''
@@ -52,7 +54,7 @@ class Banner(SurrogatePK, Model):
 
     __tablename__ = 'banners'
     filename = Column(db.String(191), unique=True, nullable=True)
-    owner = Column(db.Integer(), unique=False, nullable=False)
+    owner = Column(db.Integer(), unique=False, nullable=False, index=True)
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     url = Column(db.String(2083), nullable=False)
     height = Column(db.Integer(), nullable=True)
@@ -133,17 +135,30 @@ class Orders(SurrogatePK, Model):
     """All orders"""
 
     __tablename__ = 'orders'
+    __table_args__ = (
+        # campaigns of a user, running campaigns for the stats job
+        db.Index('ix_orders_user_stops', 'user_id', 'stops_at'),
+        db.Index('ix_orders_stops_at', 'stops_at'),
+        # calendar and bookings of a zone in a date window
+        db.Index('ix_orders_zone_begins_stops', 'zoneid', 'begins_at', 'stops_at'),
+        db.Index('ix_orders_zone_stops', 'zoneid', 'stops_at'),
+        {'extend_existing': True}
+    )
     campaigno = Column(db.Integer(), unique=True, nullable=False)
     zoneid = Column(db.Integer(), db.ForeignKey('zoneprice.zoneid', ondelete='CASCADE'), nullable=False)
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     begins_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     stops_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
-    paymentno = Column(db.Integer(), unique=False, nullable=True)
+    paymentno = Column(db.Integer(), unique=False, nullable=True, index=True)
     bannerid = Column(db.Integer(), db.ForeignKey('banners.id', ondelete='CASCADE'), nullable=False)
     name = Column(db.Text, unique=False, nullable=False)
     comments = Column(db.Text, unique=False, nullable=False)
     impressions = Column(db.Integer(), unique=False, nullable=True)
     user_id = Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    # High-water mark of the stats sync: impressions_closed is the sum of
+    # all days before stats_day, which Revive will not change any more.
+    stats_day = Column(db.Date, nullable=True)
+    impressions_closed = Column(db.Integer(), nullable=True, default=0)
 
     def __init__(self, campaigno, zoneid, created_at, begins_at,
                  stops_at, paymentno, bannerid, name, comments,
@@ -184,11 +199,16 @@ class Payments(SurrogatePK, Model):
     """All payments"""
 
     __tablename__ = 'payments'
+    # unpaid payments have received_at == datetime.min, see remove_unpaid()
+    __table_args__ = (
+        db.Index('ix_payments_received_created', 'received_at', 'created_at'),
+        {'extend_existing': True}
+    )
     created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     received_at = Column(db.DateTime, nullable=False)
     confirmed_at = Column(db.DateTime, nullable=False)
     btcpayserver_id = Column(db.String(22), nullable=False)
-    posdata = Column(db.String(36), nullable=False)
+    posdata = Column(db.String(36), nullable=False, index=True)
     fiat = Column(db.String(3), unique=False, nullable=False)
     fiat_amount = Column(db.Numeric(16, 8), nullable=False)
     user_id = Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
@@ -225,6 +245,10 @@ class Basket(SurrogatePK, Model):
     """User basket."""
 
     __tablename__ = 'basket'
+    __table_args__ = (
+        db.Index('ix_basket_user_campaigno', 'user_id', 'campaigno'),
+        {'extend_existing': True}
+    )
     user_id = Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     campaigno = Column(db.Integer(), db.ForeignKey('orders.campaigno', ondelete='CASCADE'), nullable=False)
 
@@ -245,6 +269,37 @@ class Log(SurrogatePK, Model):
     """Operational logging."""
 
     __tablename__ = 'log'
+    __table_args__ = (
+        db.Index('ix_log_user_datelog', 'user_id', 'datelog', 'id'),
+        {'extend_existing': True}
+    )
+    user_id = Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    datelog = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    logdata = Column(db.Text(), unique=False, nullable=False)
+
+    def __init__(self, user_id, datelog, logdata):
+        """Create instance."""
+        self.user_id = user_id
+        self.datelog = datelog
+        self.logdata = logdata
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return 'user_id: {}, logdata: {}, datelog: {}>'.format(
+            self.user_id,
+            self.logdata,
+            self.datelog
+        )
+
+
+class LogArchive(SurrogatePK, Model):
+    """Log rows older than LOG_RETENTION_DAYS, moved by a cron job."""
+
+    __tablename__ = 'log_archive'
+    __table_args__ = (
+        db.Index('ix_log_archive_user_datelog', 'user_id', 'datelog', 'id'),
+        {'extend_existing': True}
+    )
     user_id = Column(db.Integer(), db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     datelog = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     logdata = Column(db.Text(), unique=False, nullable=False)
@@ -268,7 +323,7 @@ class Impressions(SurrogatePK, Model):
     """Impressions cache"""
 
     __tablename__ = 'impressions'
-    zoneid = Column(db.Integer(), db.ForeignKey('zoneprice.zoneid', ondelete='CASCADE'), nullable=False)
+    zoneid = Column(db.Integer(), db.ForeignKey('zoneprice.zoneid', ondelete='CASCADE'), unique=True, nullable=False)
     impressions = Column(db.Integer(), unique=False, nullable=True)
     clicks = Column(db.Integer(), unique=False, nullable=True)
 
@@ -285,3 +340,199 @@ class Impressions(SurrogatePK, Model):
             self.impressions,
             self.clicks
         )
+
+
+class Publisher(SurrogatePK, Model):
+    """Local mirror of Revive publishers (websites)."""
+
+    __tablename__ = 'publishers'
+    publisherid = Column(db.Integer(), unique=True, nullable=False)
+    name = Column(db.String(255), unique=False, nullable=False)
+    synced_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    def __init__(self, publisherid, name, synced_at):
+        """Create instance."""
+        self.publisherid = publisherid
+        self.name = name
+        self.synced_at = synced_at
+
+    def to_revive(self):
+        '''The same fields as Revive returns for a publisher'''
+        return {
+            'publisherId': self.publisherid,
+            'publisherName': self.name
+        }
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return 'publisherid: {}, name: {}>'.format(
+            self.publisherid,
+            self.name
+        )
+
+
+class Zone(SurrogatePK, Model):
+    """Local mirror of Revive zones."""
+
+    __tablename__ = 'zones'
+    __table_args__ = (
+        db.Index('ix_zones_width_height', 'width', 'height'),
+        {'extend_existing': True}
+    )
+    zoneid = Column(db.Integer(), unique=True, nullable=False)
+    publisherid = Column(db.Integer(), db.ForeignKey('publishers.publisherid', ondelete='CASCADE'), nullable=False)
+    name = Column(db.String(255), unique=False, nullable=False)
+    width = Column(db.Integer(), nullable=True)
+    height = Column(db.Integer(), nullable=True)
+    type = Column(db.Integer(), nullable=True)
+    comments = Column(db.Text(), nullable=True)
+    synced_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    def __init__(self, zoneid, publisherid, name, width, height, type, comments, synced_at):
+        """Create instance."""
+        self.zoneid = zoneid
+        self.publisherid = publisherid
+        self.name = name
+        self.width = width
+        self.height = height
+        self.type = type
+        self.comments = comments
+        self.synced_at = synced_at
+
+    def to_revive(self):
+        '''The same fields as Revive returns for a zone'''
+        return {
+            'zoneId': self.zoneid,
+            'publisherId': self.publisherid,
+            'zoneName': self.name,
+            'width': self.width,
+            'height': self.height,
+            'type': self.type,
+            'comments': self.comments
+        }
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return 'zoneid: {}, publisherid: {}, name: {}, size: {}x{}>'.format(
+            self.zoneid,
+            self.publisherid,
+            self.name,
+            self.width,
+            self.height
+        )
+
+
+class JobRun(SurrogatePK, Model):
+    """One run of a scheduled job, see beton.scheduling."""
+
+    __tablename__ = 'job_runs'
+    __table_args__ = (
+        db.Index('ix_job_runs_job_started', 'job_id', 'started_at'),
+        {'extend_existing': True}
+    )
+    job_id = Column(db.String(64), nullable=False)
+    started_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    duration = Column(db.Float(), nullable=False)
+    items = Column(db.Integer(), nullable=False, default=0)
+    errors = Column(db.Integer(), nullable=False, default=0)
+    details = Column(db.Text(), nullable=True)
+
+    def __init__(self, job_id, started_at, duration, items, errors, details):
+        """Create instance."""
+        self.job_id = job_id
+        self.started_at = started_at
+        self.duration = duration
+        self.items = items
+        self.errors = errors
+        self.details = details
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<job_id: {}, started_at: {}, duration: {}, items: {}, errors: {}>'.format(
+            self.job_id,
+            self.started_at,
+            self.duration,
+            self.items,
+            self.errors
+        )
+
+
+class DataVersion(SurrogatePK, Model):
+    """Version of a kind of data, see beton.utils.data_version."""
+
+    __tablename__ = 'data_versions'
+    name = Column(db.String(64), unique=True, nullable=False)
+    version = Column(db.String(32), nullable=False)
+
+    def __init__(self, name, version):
+        """Create instance."""
+        self.name = name
+        self.version = version
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<name: {}, version: {}>'.format(
+            self.name,
+            self.version
+        )
+
+
+class StatsFact(object):
+    """Impressions and clicks of one campaign or zone in one time bucket.
+
+    Keys are plain integers to keep rows small: `kind` tells campaigns
+    (KIND_CAMPAIGN, entity is campaigno) from zones (KIND_ZONE, entity is
+    zoneid), buckets are numbered from the Unix epoch, see beton.user.timeseries.
+    """
+
+    KIND_CAMPAIGN = 1
+    KIND_ZONE = 2
+
+    kind = Column(db.SmallInteger(), primary_key=True, autoincrement=False)
+    entity = Column(db.Integer(), primary_key=True, autoincrement=False)
+    impressions = Column(db.Integer(), nullable=False, default=0)
+    clicks = Column(db.Integer(), nullable=False, default=0)
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<{}: kind: {}, entity: {}, bucket: {}, impressions: {}, clicks: {}>'.format(
+            self.__class__.__name__,
+            self.kind,
+            self.entity,
+            self.bucket,
+            self.impressions,
+            self.clicks
+        )
+
+
+class StatsHourly(StatsFact, Model):
+    """Append-only hourly facts, hour is the number of hours since the epoch."""
+
+    __tablename__ = 'stats_hourly'
+    hour = Column(db.Integer(), primary_key=True, autoincrement=False)
+
+    @property
+    def bucket(self):
+        return self.hour
+
+
+class StatsDaily(StatsFact, Model):
+    """Daily rollup, day is the number of days since the epoch."""
+
+    __tablename__ = 'stats_daily'
+    day = Column(db.Integer(), primary_key=True, autoincrement=False)
+
+    @property
+    def bucket(self):
+        return self.day
+
+
+class StatsMonthly(StatsFact, Model):
+    """Monthly rollup, month is the number of months since January 1970."""
+
+    __tablename__ = 'stats_monthly'
+    month = Column(db.Integer(), primary_key=True, autoincrement=False)
+
+    @property
+    def bucket(self):
+        return self.month
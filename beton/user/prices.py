@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Day prices and overview rectangles of zones, kept in every worker.
+
+The zoneprice table is tiny and changes only when an admin edits the
+offer or a new zone is mirrored from Revive, so every worker process
+keeps all of it in a dict. Writers call `prices_changed`, which bumps
+the version stamp of prices in the database; a worker reloads the dict
+when it sees another stamp, which it checks once per request. Until
+prices get their first stamp nothing would tell a worker about changes,
+so they are read from the database every time.
+
+A zone may still have no price, e.g. for a moment after it was mirrored,
+so callers must be ready for `price_table.get` to return None.
+"""
+import threading
+from collections import namedtuple
+
+from flask import g
+
+from beton.extensions import db
+from beton.user.models import Prices
+from beton.utils import bump_data_version, data_version
+
+ZonePrice = namedtuple('ZonePrice', ['zoneid', 'dayprice', 'x0', 'y0', 'x1', 'y1'])
+
+# the table was not loaded yet
+_NOT_LOADED = object()
+
+
+def prices_version():
+    """Version stamp of prices, read from the database once per request or job run."""
+    if 'prices_version' not in g:
+        g.prices_version = data_version('prices')
+    return g.prices_version
+
+
+def prices_changed():
+    """Make all workers reload prices, call it after committing a change."""
+    bump_data_version('prices')
+    g.pop('prices_version', None)
+
+
+class PriceTable(object):
+    """Prices of all zones by zone ID, as of a version stamp."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._version = _NOT_LOADED
+        self._prices = {}
+
+    def init_app(self, app):
+        # forget prices of the database of a previous app
+        with self._lock:
+            self._reset()
+
+    @staticmethod
+    def _load():
+        return {row.zoneid: ZonePrice(*row) for row in db.session.query(
+            Prices.zoneid, Prices.dayprice, Prices.x0, Prices.y0, Prices.x1, Prices.y1)}
+
+    def all(self):
+        version = prices_version()
+        if version is None:
+            # prices were never stamped, read the database
+            return self._load()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._prices = self._load()
+                    self._version = version
+        return self._prices
+
+    def get(self, zoneid):
+        """ZonePrice of a zone, or None if it has no price."""
+        price = self.all().get(zoneid)
+        if price is None:
+            # a zone priced after our stamp was read
+            row = db.session.query(Prices.zoneid, Prices.dayprice, Prices.x0, Prices.y0,
+                                   Prices.x1, Prices.y1).filter(Prices.zoneid == zoneid).first()
+            price = ZonePrice(*row) if row else None
+        return price
+
+
+price_table = PriceTable()
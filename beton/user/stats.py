@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Statistics from Revive, copied into SQL for fast access."""
+from datetime import date, datetime, time, timedelta
+
+from dateutil.relativedelta import relativedelta
+from flask import current_app
+
+from beton.database import upsert
+from beton.extensions import db, revive
+from beton.logger import log
+from beton.user.models import Impressions, Orders, StatsFact
+from beton.user.timeseries import record
+
+# Revive keeps adding late impressions to the last day for a while,
+# so only days older than that are treated as final.
+CLOSED_AFTER = timedelta(days=1)
+
+
+def _day(value):
+    """Day of a statistics row, it may come as a string or xmlrpc DateTime."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value).replace('-', '')[:8], '%Y%m%d').date()
+
+
+def sync_campaign_stats(now=None):
+    '''Update impressions of all running campaigns.
+
+    Every campaign remembers the first day which is not final yet, so only
+    these few days are asked for, for all campaigns at once. Everything is
+    written with one bulk update, and the days go to the hourly facts.
+    Returns a dict with numbers of updated and failed campaigns.
+    '''
+    now = now or datetime.utcnow()
+    today = now.date()
+    closed_until = today - CLOSED_AFTER
+    stats = {'updated': 0, 'failed': 0}
+
+    # we update only currently ongoing campaigns
+    orders = db.session.query(
+        Orders.id, Orders.campaigno, Orders.begins_at,
+        Orders.stats_day, Orders.impressions_closed
+    ).filter(Orders.stops_at >= now).all()
+    if not orders:
+        return stats
+
+    starts = [order.stats_day or order.begins_at.date() for order in orders]
+    results = revive.batch(
+        (('ox.campaignDailyStatistics',
+          (order.campaigno, datetime.combine(start, time()), now))
+         for order, start in zip(orders, starts)),
+        return_exceptions=True
+    )
+
+    mappings = []
+    totals = {}
+    for order, start, result in zip(orders, starts, results):
+        if isinstance(result, Exception):
+            # mostly a campaign which was removed from Revive
+            log.debug("No stats for campaign %s: %s" % (order.campaigno, result))
+            stats['failed'] += 1
+            continue
+        closed = order.impressions_closed or 0
+        recent = 0
+        for row in result:
+            totals[(order.campaigno, _day(row['day']))] = (row['impressions'], row['clicks'])
+            if _day(row['day']) < closed_until:
+                closed += row['impressions']
+            else:
+                recent += row['impressions']
+        mappings.append({
+            'id': order.id,
+            'impressions': closed + recent,
+            'impressions_closed': closed,
+            'stats_day': max(start, closed_until)
+        })
+        stats['updated'] += 1
+
+    db.session.bulk_update_mappings(Orders, mappings)
+    record(StatsFact.KIND_CAMPAIGN, totals, now)
+    db.session.commit()
+    return stats
+
+
+def sync_zone_stats(now=None):
+    """Store impressions and clicks of all zones.
+
+    Totals of the last month, aggregated across all customers, are written
+    with one upsert. Totals of yesterday and today go to the hourly facts.
+    Returns the number of zones.
+    """
+    now = now or datetime.utcnow()
+    today = datetime.combine(now.date(), time())
+    yesterday = today - timedelta(days=1)
+    agency_id = current_app.config.get('REVIVE_AGENCY_ID')
+    ztatz, *days = revive.batch([
+        ('ox.agencyZoneStatistics', (agency_id, now - relativedelta(months=1), now)),
+        ('ox.agencyZoneStatistics', (agency_id, yesterday, today - timedelta(seconds=1))),
+        ('ox.agencyZoneStatistics', (agency_id, today, now))
+    ])
+    upsert(Impressions, [{
+        'zoneid': zone['zoneId'],
+        'impressions': zone['impressions'],
+        'clicks': zone['clicks']
+    } for zone in ztatz], ['zoneid'])
+    record(StatsFact.KIND_ZONE, {
+        (zone['zoneId'], day.date()): (zone['impressions'], zone['clicks'])
+        for day, zones in zip((yesterday, today), days) for zone in zones
+    }, now)
+    db.session.commit()
+    return len(ztatz)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""Hourly impressions and clicks of campaigns and zones, with rollups.
+
+Revive only tells how many impressions there were so far on a given day.
+Every run of the stats job stores the growth since its previous run as
+the fact of the current hour, and keeps the daily and monthly rollups up
+to date, so charts never need to ask Revive.
+
+Buckets are plain integers: hours and days since the Unix epoch, months
+since January 1970.
+"""
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func
+
+from beton.database import upsert
+from beton.extensions import db
+from beton.user.models import StatsDaily, StatsHourly, StatsMonthly
+
+EPOCH = date(1970, 1, 1)
+# keep IN (...) lists well under the limits of all databases
+CHUNK = 500
+
+
+def day_of(when):
+    if isinstance(when, datetime):
+        when = when.date()
+    return (when - EPOCH).days
+
+
+def hour_of(when):
+    return day_of(when) * 24 + when.hour
+
+
+def month_of(when):
+    return (when.year - 1970) * 12 + when.month - 1
+
+
+def from_day(day):
+    return datetime.combine(EPOCH + timedelta(days=day), datetime.min.time())
+
+
+def from_hour(hour):
+    return from_day(hour // 24) + timedelta(hours=hour % 24)
+
+
+def from_month(month):
+    return datetime(1970 + month // 12, month % 12 + 1, 1)
+
+
+GRAINS = {
+    'hour': (StatsHourly, StatsHourly.hour, hour_of, from_hour),
+    'day': (StatsDaily, StatsDaily.day, day_of, from_day),
+    'month': (StatsMonthly, StatsMonthly.month, month_of, from_month)
+}
+
+
+def _chunks(items):
+    items = sorted(items)
+    for start in range(0, len(items), CHUNK):
+        yield items[start:start + CHUNK]
+
+
+def record(kind, totals, now=None):
+    '''Store daily totals from Revive as hourly facts and rollups.
+
+    `totals` maps `(entity, day)` to `(impressions, clicks)` so far on that
+    day. What is not in the hourly facts of that day yet goes to the current
+    hour, or to the last hour of a day which is already over.
+    It does not commit. Returns the number of written hourly facts.
+    '''
+    now = now or datetime.utcnow()
+    if not totals:
+        return 0
+    today = day_of(now)
+    days = set(day_of(day) for (entity, day) in totals)
+    entities = set(entity for (entity, day) in totals)
+
+    # hourly facts we already have for these days
+    recorded = {}
+    for chunk in _chunks(entities):
+        for entity, hour, impressions, clicks in db.session.query(
+                StatsHourly.entity, StatsHourly.hour,
+                StatsHourly.impressions, StatsHourly.clicks).filter(
+                    StatsHourly.kind == kind,
+                    StatsHourly.entity.in_(chunk),
+                    StatsHourly.hour >= min(days) * 24,
+                    StatsHourly.hour < (max(days) + 1) * 24):
+            recorded.setdefault((entity, hour // 24), {})[hour] = (impressions, clicks)
+
+    hourly, daily = [], []
+    for (entity, day), (impressions, clicks) in totals.items():
+        day = day_of(day)
+        hour = hour_of(now) if day == today else day * 24 + 23
+        hours = recorded.get((entity, day), {})
+        before = [value for (at, value) in hours.items() if at != hour]
+        value = (max(impressions - sum(v[0] for v in before), 0),
+                 max(clicks - sum(v[1] for v in before), 0))
+        if value != hours.get(hour, (0, 0)):
+            hourly.append({'kind': kind, 'entity': entity, 'hour': hour,
+                           'impressions': value[0], 'clicks': value[1]})
+        daily.append({'kind': kind, 'entity': entity, 'day': day,
+                      'impressions': impressions, 'clicks': clicks})
+    upsert(StatsHourly, hourly, ['kind', 'entity', 'hour'])
+    upsert(StatsDaily, daily, ['kind', 'entity', 'day'])
+
+    # monthly rollups of the touched months, summed from daily ones
+    for month in set(month_of(from_day(day)) for day in days):
+        first = day_of(from_month(month))
+        last = day_of(from_month(month + 1))
+        for chunk in _chunks(entities):
+            upsert(StatsMonthly, [{
+                'kind': kind, 'entity': entity, 'month': month,
+                'impressions': int(impressions), 'clicks': int(clicks)
+            } for entity, impressions, clicks in db.session.query(
+                StatsDaily.entity, func.sum(StatsDaily.impressions),
+                func.sum(StatsDaily.clicks)).filter(
+                    StatsDaily.kind == kind,
+                    StatsDaily.entity.in_(chunk),
+                    StatsDaily.day >= first,
+                    StatsDaily.day < last).group_by(StatsDaily.entity)],
+                ['kind', 'entity', 'month'])
+    return len(hourly)
+
+
+def series(kind, entity, start, end, grain='day'):
+    """Impressions, clicks and CTR of one campaign or zone, from start to end.
+
+    Buckets without any impressions are left out.
+    """
+    model, column, to_bucket, from_bucket = GRAINS[grain]
+    rows = db.session.query(column, model.impressions, model.clicks).filter(
+        model.kind == kind,
+        model.entity == entity,
+        column >= to_bucket(start),
+        column <= to_bucket(end)
+    ).order_by(column)
+    return [{
+        'time': from_bucket(bucket),
+        'impressions': impressions,
+        'clicks': clicks,
+        'ctr': clicks / impressions if impressions else 0.0
+    } for bucket, impressions, clicks in rows]
@@ -1,32 +1,45 @@
 # -*- coding: utf-8 -*-
 import btcpay
+import hashlib
+import json
 import names
 import pickle
 import pprint
-import random
 import uuid
-# All revive XML RPC commands:
-# https://github.com/revive-adserver/revive-adserver/blob/master/www/api/v2/xmlrpc/index.php
-import xmlrpc.client
+import zlib
 
 from datetime import datetime, timedelta
 from dateutil.relativedelta import *
 from PIL import Image, ImageDraw
 
 from flask import Blueprint, current_app, flash, g, jsonify, redirect
-from flask import render_template, request, session, url_for
+from flask import Response, render_template, request, session, stream_with_context, url_for
 from flask_security import current_user, login_required, roles_accepted
 from flask_uploads import UploadSet, IMAGES
 
-from beton.extensions import cache
+from beton.database import DaysBetween
+from beton.dbpool import pool_status
+from beton.extensions import cache, db, revive
 from beton.logger import log
+from beton.scheduling import job_status
 from beton.user.forms import AddBannerForm, AddBannerTextForm, AddPairingTextForm, ChangeOffer
-from beton.user.models import Banner, Basket, Impressions, Log, Orders, Payments, Prices, User
-from beton.utils import dblogger, flash_errors, reviveme
+from beton.user.advertisers import provision_advertiser
+from beton.user.availability import book, booked_days, campaign_days, free_days, is_free
+from beton.user.campaigns import campaign_page, campaign_query, campaign_row, campaigns_json
+from beton.user.heatmap import heatmap
+from beton.user.inventory import get_publishers, get_zones, sync_inventory
+from beton.user.logs import export_csv, log_page
+from beton.user.models import Banner, Basket, Impressions, Orders, Payments, Prices, StatsFact, User
+from beton.user.prices import price_table, prices_changed, prices_version
+from beton.user.timeseries import GRAINS, series
+from beton.utils import bump_data_version, data_version, dblogger, flash_errors
 
 blueprint = Blueprint('user', __name__, url_prefix='/me', static_folder='../static')
 images = UploadSet('images', IMAGES)
 
+# (user id, number of items in the basket), see get_basket
+BASKET_COUNT_KEY = 'basket_count'
+
 
 def amiadmin():
     if current_user.has_role('admin'):
@@ -36,14 +49,16 @@ def amiadmin():
     return isadmin
 
 
-def random_color():
-    color = "%03x" % random.randint(0, 0xFFF)
+def campaign_color(campaigno):
+    """Colour of a campaign in calendars, the same in every response."""
+    color = "%03x" % (zlib.crc32(str(campaigno).encode()) & 0xFFF)
     return "#"+str(color)
 
 
-# it is safe to cache it for 10 minutes or even more
+# it is safe to cache it for 10 minutes or even more,
+# a new version of prices makes a new memo
 @cache.memoize(600)
-def create_banner_overview(zone):
+def create_banner_overview(zone, version=None):
     destpath = (current_app.config.get('UPLOADED_IMAGES_DEST') +
                 "/overview/zone-%s.png" % str(zone))
     dwg = Image.new(
@@ -55,7 +70,9 @@ def create_banner_overview(zone):
         color='red'
     )
 
-    zonedata = Prices.query.filter_by(zoneid=zone).first()
+    zonedata = price_table.get(zone)
+    if zonedata is None:
+        return
     # font = ImageFont.load_default()
 
     b = ImageDraw.Draw(dwg)
@@ -84,87 +101,58 @@ def create_banner_overview(zone):
     dwg.save(destpath, 'PNG')
 
 
-@cache.memoize(timeout=666)
-def all_advertisers_cached(r):
-    '''We want to cache data which does not change frequently
-       as asking revive is time costly.'''
-    sessionid = session['revive']
-    all_advertisers = r.ox.getAdvertiserListByAgencyId(
-        sessionid,
-        current_app.config.get('REVIVE_AGENCY_ID')
-    )
-    return all_advertisers
+def get_advertiser_id():
+    '''Revive advertiser ID of the current user.'''
+    return provision_advertiser(current_user)
 
 
-def get_advertiser_id():
-    '''Try to find out if the customer is already registered
-       in Revive, if not, register him.'''
-    r = xmlrpc.client.ServerProxy(
-        current_app.config.get('REVIVE_XML_URI'),
-        verbose=False
-    )
-    sessionid = session['revive']
-    all_advertisers = all_advertisers_cached(r)
+def basket_items(user_id):
+    """Whole basket of a user in one query.
 
-    try:
-        next(x for x in all_advertisers if x['advertiserName'] ==
-             current_user.username)
-    except StopIteration:
-        r.ox.addAdvertiser(
-            sessionid,
-            {
-                'agencyId': current_app.config.get('REVIVE_AGENCY_ID'),
-                'advertiserName': current_user.username,
-                'emailAddress': current_user.email,
-                'contactName': current_user.username,
-                'comments': current_app.config.get('USER_APP_NAME')
-            }
-        )
-        log.info("Added {} as new advertiser.".format(current_user.username))
-        cache.delete_memoized(all_advertisers_cached)
-        all_advertisers = all_advertisers_cached(r)
+    Every row is an Orders object with columns of its banner, the day price
+    and `line_total`, the price of the whole campaign computed in SQL. It is
+    a float on every database, MySQL and PostgreSQL would give a Decimal,
+    which the BTCPay client can not serialise.
+    """
+    line_total = db.type_coerce(
+        Prices.dayprice * (DaysBetween(Orders.begins_at, Orders.stops_at) + 1) / 100.0, db.Float
+    ).label('line_total')
+    return db.session.query(Orders).join(
+        Basket, Basket.campaigno == Orders.campaigno).join(
+            Banner, Orders.bannerid == Banner.id).join(
+                Prices, Orders.zoneid == Prices.zoneid).add_columns(
+                    Banner.filename, Banner.url, Banner.width, Banner.height,
+                    Banner.content, Banner.icon, Banner.type, Prices.dayprice,
+                    line_total).filter(
+                        Basket.user_id == user_id).order_by(Basket.id).all()
 
-    advertiser_id = int(next(x for x in all_advertisers if x['advertiserName'] ==
-                             current_user.username)['advertiserId'])
-    return advertiser_id
+
+def forget_basket_count():
+    """Make get_basket count the basket again, after it was changed."""
+    session.pop(BASKET_COUNT_KEY, None)
 
 
 @blueprint.url_value_preprocessor
 def get_basket(endpoint, values):
-    """We need basket on every view if authenticated"""
-    if current_user.is_authenticated:
-        try:
-            basket_sql = Basket.query.filter_by(user_id=current_user.id).all()
-            if basket_sql:
-                g.basket = len(basket_sql)
-            else:
-                g.basket = 0
-        except Exception as e:
-            # # TODO: it might be required for minor used servers,
-            # # as after 8 hours we are getting disconnected from mysqld
-            # db.session.rollback()
-            log.exception(e)
-            pass
+    """We need basket on every view if authenticated
 
-    # keeping constant connection to Revive instance
-    r = xmlrpc.client.ServerProxy(
-        current_app.config.get('REVIVE_XML_URI'),
-        verbose=False
-    )
-    if 'revive' in session:
-        sessionid = session['revive']
+    The number of items is kept in the session, so usually it costs no
+    query; views changing the basket call forget_basket_count().
+    JSON endpoints have no navbar, so they are skipped.
+    """
+    view = (endpoint or '').rsplit('.', 1)[-1]
+    if view.startswith('api_') or view.endswith('_json') or view == 'static':
+        return
+    if current_user.is_authenticated:
         try:
-            r.ox.getUserList(sessionid)
-        except xmlrpc.client.Fault:
-            log.debug("XML-RPC session to Revive probably expired, getting new one.")
-            sessionid = reviveme(r)
-            session['revive'] = sessionid
+            user_id, count = session.get(BASKET_COUNT_KEY, (None, 0))
+            if user_id != current_user.id:
+                count = Basket.query.filter_by(user_id=current_user.id).count()
+                session[BASKET_COUNT_KEY] = (current_user.id, count)
+            g.basket = count
         except Exception as e:
+            db.session.rollback()
             log.exception(e)
-    else:
-        sessionid = reviveme(r)
-        session['revive'] = sessionid
-    # vers we need globally
 
 
 @blueprint.route('/me')
@@ -260,85 +248,33 @@ def offer():
     """Get and display all possible websites and zones in them."""
     form = ChangeOffer()
 
-    r = xmlrpc.client.ServerProxy(
-        current_app.config.get('REVIVE_XML_URI'),
-        verbose=False
-    )
-    sessionid = session['revive']
-    advertiser_id = get_advertiser_id()
-
-    # Get all publishers (websites)
-    publishers = r.ox.getPublisherListByAgencyId(
-        sessionid,
-        current_app.config.get('REVIVE_AGENCY_ID')
-    )
-
-    # ignore the websites on our blacklist 
-    for blackwebsite in current_app.config.get('REVIVE_IGNORED_WEBSITES'):
-        for website in publishers:
-            if website['publisherName'] == blackwebsite:
-                publishers.remove(website)
+    # Get all publishers (websites) and their zones from our local mirror
+    publishers = [website.to_revive() for website in get_publishers()]
+    all_impressions = dict(db.session.query(Impressions.zoneid, Impressions.impressions))
 
     all_zones = []
-    for website in publishers:
-
-        # get zones from Revive
-        allzones = r.ox.getZoneListByPublisherId(
-            sessionid,
-            website['publisherId']
+    for zone, price in get_zones(all_sizes=True):
+        if price is None:
+            log.info("Zone %s has no price yet, it is not offered." % zone.zoneid)
+            continue
+        tmpdict = zone.to_revive()
+
+        tmpdict['price'] = price.dayprice
+        tmpdict['x0'] = price.x0
+        tmpdict['x1'] = price.x1
+        tmpdict['y0'] = price.y0
+        tmpdict['y1'] = price.y1
+
+        # get stats and ignore if none
+        tmpdict['impressions'] = all_impressions.get(zone.zoneid) or 0
+
+        all_zones.append(tmpdict)
+
+        # Prepare overview image
+        create_banner_overview(
+            zone.zoneid,
+            prices_version()
         )
-        for zone in allzones:
-            # First check if the zone from Revive is available in our Price
-            # database, of not, we are creating it with zero values
-            howmany = Prices.query.filter_by(zoneid=zone['zoneId']).count()
-            if howmany is not 1:
-                Prices.create(
-                    zoneid=zone['zoneId'],
-                    dayprice=0,
-                    x0=0,
-                    x1=0,
-                    y0=0,
-                    y1=0
-                )
-                Prices.commit()
-
-            price = Prices.query.filter_by(
-                        zoneid=zone['zoneId']
-                    ).first()
-
-            tmpdict = {}
-
-            tmpdict['publisherId'] = zone['publisherId']
-            tmpdict['zoneName'] = zone['zoneName']
-            tmpdict['width'] = zone['width']
-            tmpdict['height'] = zone['height']
-            tmpdict['zoneId'] = zone['zoneId']
-            tmpdict['comments'] = zone['comments']
-            tmpdict['type'] = zone['type']
-
-            tmpdict['price'] = price.dayprice
-            tmpdict['x0'] = price.x0
-            tmpdict['x1'] = price.x1
-            tmpdict['y0'] = price.y0
-            tmpdict['y1'] = price.y1
-
-            # get stats and ignore if none
-            try:
-                ztatz = Impressions.query.filter_by(
-                            zoneid=zone['zoneId']
-                        ).first()
-                tmpdict['impressions'] = ztatz.impressions
-            except Exception as e:
-                log.debug("Exception")
-                log.exception(e)
-                tmpdict['impressions'] = 0
-
-            all_zones.append(tmpdict)
-
-            # Prepare overview image
-            create_banner_overview(
-                zone['zoneId']
-            )
 
     if request.method == 'POST':
         log.debug(pprint.pformat(request.form, depth=5))
@@ -356,6 +292,7 @@ def offer():
                             }
                         )
                     Prices.commit()
+                    prices_changed()
 
         return redirect(url_for('user.offer'))
 
@@ -369,6 +306,21 @@ def offer():
     )
 
 
+@blueprint.route('/admin/inventory/resync', methods=['POST'])
+@roles_accepted('admin')
+def resync_inventory():
+    """Synchronise publishers and zones with Revive right now."""
+    try:
+        stats = sync_inventory()
+        flash('Zones were synchronised with Revive: {added} added, {updated} updated, {removed} removed.'.format(
+            **stats), 'success')
+    except Exception as e:
+        log.debug("Exception")
+        log.exception(e)
+        flash('Synchronisation with Revive failed. Check logs or repeat.', 'error')
+    return redirect(url_for('user.offer'))
+
+
 @blueprint.route('/campaign')
 @blueprint.route('/campaign/duration/<int:no_weeks>')
 @blueprint.route('/campaign/details/<int:campaign_no>')
@@ -383,49 +335,13 @@ def campaign(no_weeks=None, campaign_no=None, invoice_uuid=None):
     # And now we are checking campaigns
     if not no_weeks:  # we show 1 month of recent campaigns by default
         no_weeks = 4
-    r = xmlrpc.client.ServerProxy(
-        current_app.config.get('REVIVE_XML_URI'),
-        verbose=False
-    )
-    sessionid = session['revive']
-
-    advertiser_id = get_advertiser_id()
-
-    # A universal JOIN across tables to get info about an order
-    dbqueryall = Orders.query.join(
-        Payments, Orders.paymentno == Payments.id).join(
-            Banner, Orders.bannerid == Banner.id).add_columns(
-                Orders.user_id,
-                Orders.begins_at,
-                Orders.stops_at,
-                Orders.created_at,
-                Orders.zoneid,
-                Orders.campaigno,
-                Orders.bannerid,
-                Orders.name,
-                Orders.comments,
-                Orders.impressions,
-                Payments.posdata,
-                Payments.btcpayserver_id,
-                Payments.received_at,
-                Payments.confirmed_at,
-                Payments.fiat_amount,
-                Payments.fiat,
-                Banner.filename,
-                Banner.url,
-                Banner.width,
-                Banner.height,
-                Banner.content,
-                Banner.icon,
-                Banner.type
-            )
 
     # We are converting invoice UUID we generated for campaing_no
     # to quickly find an invoice from payment processor user interface
     # Please not there may be more campaigns related to one invoice,
     # we are just showing one of them!
     if invoice_uuid is not None:
-        dbquery = dbqueryall.filter(Payments.posdata == invoice_uuid).first()
+        dbquery = campaign_row(campaign_query().filter(Payments.posdata == invoice_uuid))
         if dbquery.campaigno:
             campaign_no = dbquery.campaigno
 
@@ -444,7 +360,7 @@ def campaign(no_weeks=None, campaign_no=None, invoice_uuid=None):
             return render_template('users/paymentsystem-problems.html')
 
         # we are getting overview of particular campaign from local database
-        dbquery = dbqueryall.filter(Orders.campaigno == campaign_no).first()
+        dbquery = campaign_row(campaign_query().filter(Orders.campaigno == campaign_no))
         # and now we check details of that payment from downstream payment processor
         log.debug(dbquery)
         if dbquery.btcpayserver_id:  # we are checking it only for historical
@@ -472,17 +388,19 @@ def campaign(no_weeks=None, campaign_no=None, invoice_uuid=None):
             # We politely redirecting 'hackers' to all campaigns
             return redirect(url_for("user.campaign"), code=302)
 
-    # admin gets all campaigns for all users limited to requested time period
-    dbqueryall = dbqueryall.filter(Orders.stops_at > datetime.utcnow() - timedelta(weeks=no_weeks))
-    if amiadmin():
-        all_campaigns = dbqueryall.all()
-    else:
-        all_campaigns = dbqueryall.filter(Orders.user_id == current_user.id).all()
+    # admin gets all campaigns for all users limited to requested time period,
+    # a page at a time
+    all_campaigns, older = campaign_page(
+        datetime.utcnow() - timedelta(weeks=no_weeks),
+        user_id=None if amiadmin() else current_user.id,
+        cursor=request.args.get('before')
+    )
 
     # Render the page and quit
     return render_template(
         'users/campaign.html',
         all_campaigns=all_campaigns,
+        older=older,
         roles=current_user.roles,
         now=datetime.utcnow(),
         datemin=datetime.min,
@@ -490,50 +408,137 @@ def campaign(no_weeks=None, campaign_no=None, invoice_uuid=None):
     )
 
 
+@blueprint.route('/campaign.json')
+@blueprint.route('/campaign/duration/<int:no_weeks>.json')
+@login_required
+def campaign_json(no_weeks=4):
+    """All campaigns of the list above, streamed as one JSON array."""
+    return Response(
+        stream_with_context(campaigns_json(
+            datetime.utcnow() - timedelta(weeks=no_weeks),
+            user_id=None if amiadmin() else current_user.id
+        )),
+        mimetype='application/json'
+    )
+
+
+def calendar_day(value, default):
+    """Date from FullCalendar's start/end, which may carry a time and zone."""
+    try:
+        return datetime.strptime(value[:10], "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return default
+
+
+# shared by all users, so a short timeout is enough to absorb navigation;
+# a new version of orders makes a new memo
+@cache.memoize(60)
+def calendar_events(zone_id, start, end, version=None):
+    """JSON body and its ETag of campaigns in a zone (0 = all) between dates."""
+    query = db.session.query(
+        Orders.campaigno, Orders.name, Orders.zoneid, Orders.begins_at, Orders.stops_at
+    ).filter(Orders.begins_at < end, Orders.stops_at >= start)
+    if zone_id != 0:
+        query = query.filter(Orders.zoneid == zone_id)
+    ac = []
+    for order in query.order_by(Orders.begins_at, Orders.campaigno):
+        if (order.stops_at - order.begins_at).days < 1:
+            calendarend = order.stops_at
+        else:
+            calendarend = order.stops_at + timedelta(days=1)
+        ac.append({
+            'id': order.campaigno,
+            'title': order.name,
+            'allDay': "true",
+            'color': campaign_color(order.campaigno),
+            'resourceId': order.zoneid,
+            'start': order.begins_at.strftime("%Y-%m-%d"),
+            'end': calendarend.strftime("%Y-%m-%d")
+        })
+    body = json.dumps(ac, separators=(',', ':'))
+    return body, hashlib.md5(body.encode()).hexdigest()
+
+
+@blueprint.route('/api/free_days_in_zone/<int:zone_id>')
+@login_required
+def api_free_days(zone_id):
+    """Days of a zone which can be booked, from `start` to `end` (YYYY-MM-DD),
+    by default for the next 90 days."""
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    start = calendar_day(request.args.get('start'), today)
+    end = calendar_day(request.args.get('end'), today + timedelta(days=90))
+    if (end - start).days > 366:
+        return jsonify({'error': 'The window is longer than a year.'}), 400
+    return jsonify({
+        'zone': zone_id,
+        'start': start.strftime("%Y-%m-%d"),
+        'end': end.strftime("%Y-%m-%d"),
+        'free': [day.strftime("%Y-%m-%d") for day in free_days(zone_id, start, end)]
+    })
+
+
 @blueprint.route('/api/all_campaigns_in_zone/<int:zone_id>')
 @login_required
 def api_all_campaigns(zone_id):
     """JSON:
     https://fullcalendar.io/docs/event-object
+
+    Only campaigns overlapping the `start` - `end` window of the calendar
+    are sent, by default from 3 months ago to a year ahead.
     """
-    # TODO: get timescales from fullcalendar uri
-    # start = request.args.get('start')
-    # end = request.args.get('end')
-    # Get all orders from local database
-    if zone_id == 0:
-        all_orders = Orders.query.all()
-    else:
-        all_orders = Orders.query.filter_by(zoneid=zone_id).all()
-    ac = []
-    for order in all_orders:
-        tasks = {}
-        fullname = order.name
-        tasks['id'] = order.campaigno
-        tasks['title'] = fullname
-        tasks['allDay'] = "true"
-        tasks['color'] = random_color()
-        tasks['resourceId'] = order.zoneid
-        starttime = order.begins_at
-        endtime = order.stops_at
-        tasks['start'] = starttime.strftime("%Y-%m-%d")
-        if (endtime - starttime).days < 1:
-            calendarend = endtime
-        else:
-            calendarend = endtime + timedelta(days=1)
-        tasks['end'] = calendarend.strftime("%Y-%m-%d")
-        ac.append(tasks)
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    start = calendar_day(request.args.get('start'), today - timedelta(days=90))
+    end = calendar_day(request.args.get('end'), today + timedelta(days=365))
+    body, etag = calendar_events(zone_id, start, end, data_version('orders'))
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
+
+@blueprint.route('/api/stats/campaign/<int:entity>', defaults={'kind': 'campaign'})
+@blueprint.route('/api/stats/zone/<int:entity>', defaults={'kind': 'zone'})
+@login_required
+def api_stats(kind, entity):
+    """JSON: impressions, clicks and CTR of a campaign or zone over time.
 
-    return jsonify(ac)
+    Query arguments: grain (hour, day or month), start and end (YYYY-MM-DD),
+    by default daily values of the last 30 days.
+    """
+    grain = request.args.get('grain', 'day')
+    if grain not in GRAINS:
+        return jsonify({'error': 'Unknown grain.'}), 400
+    try:
+        end = datetime.strptime(request.args['end'], '%Y-%m-%d') if 'end' in request.args \
+            else datetime.utcnow()
+        start = datetime.strptime(request.args['start'], '%Y-%m-%d') if 'start' in request.args \
+            else end - timedelta(days=30)
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD.'}), 400
+    if kind == 'campaign':
+        # users can see only their own campaigns
+        if not current_user.has_role('admin') and Orders.query.filter_by(
+                campaigno=entity, user_id=current_user.id).first() is None:
+            return jsonify({'error': 'No such campaign.'}), 404
+        kind = StatsFact.KIND_CAMPAIGN
+    else:
+        kind = StatsFact.KIND_ZONE
+    points = series(kind, entity, start, end, grain)
+    impressions = sum(point['impressions'] for point in points)
+    clicks = sum(point['clicks'] for point in points)
+    return jsonify({
+        'impressions': impressions,
+        'clicks': clicks,
+        'ctr': clicks / impressions if impressions else 0.0,
+        'series': points
+    })
 
 
 @blueprint.route('/order', methods=['get', 'post'])
 @login_required
 def order():
     """Order a campaign."""
-    r = xmlrpc.client.ServerProxy(current_app.config.get('REVIVE_XML_URI'),
-                                  verbose=False)
-    sessionid = session['revive']
-
     if ('step' not in request.form) or \
             ('submit' in request.form.values() and request.form['submit'] == 'cancel'):
         all_banners = Banner.query.filter_by(owner=current_user.id).all()
@@ -551,35 +556,14 @@ def order():
         banner = Banner.query.filter_by(id=banner_id).first()
         image_url = images.url(banner.filename)
 
-        # Get all publishers (websites)
-        publishers = r.ox.getPublisherListByAgencyId(
-            sessionid,
-            current_app.config.get('REVIVE_AGENCY_ID')
-        )
-
-        # ignore the websites on our blacklist 
-        for blackwebsite in current_app.config.get('REVIVE_IGNORED_WEBSITES'):
-            for website in publishers:
-                if website['publisherName'] == blackwebsite:
-                    publishers.remove(website)
-
-        # Get zones from Revive
+        # Get zones of the banner size from our local mirror
         all_zones = []
-
-        for website in publishers:
-            allzones = r.ox.getZoneListByPublisherId(
-                sessionid,
-                website['publisherId']
-            )
-            for zone in allzones:
-                price = Prices.query.filter_by(zoneid=zone['zoneId']).first()
-                if not price:
-                    return render_template('users/order-noprice.html')
-                zone_width = zone['width']
-                zone_height = zone['height']
-                zone['price'] = price
-                if zone_width == banner.width and zone_height == banner.height:
-                    all_zones.append(zone)
+        for zone, price in get_zones(width=banner.width, height=banner.height):
+            if not price:
+                return render_template('users/order-noprice.html')
+            zone = zone.to_revive()
+            zone['price'] = price
+            all_zones.append(zone)
         return render_template('users/order.html', banner=banner,
                                image_url=image_url,
                                all_zones=all_zones, step='chose-zone')
@@ -590,9 +574,13 @@ def order():
         image_url = images.url(banner.filename)
         zone_id = int(request.form['zone_id'])
         zone_name = request.form['zone_name']
+        # taken days are disabled in the date pickers
+        today = datetime.utcnow()
+        taken = booked_days(zone_id, today, today + timedelta(days=365))
         return render_template('users/order.html', banner_id=banner_id,
                                zone_id=zone_id, image_url=image_url,
                                zone_name=zone_name, banner=banner,
+                               taken=[day.strftime("%d/%m/%Y") for day in taken],
                                step='chose-date')
 
     elif request.form['step'] == 'order':
@@ -608,7 +596,9 @@ def order():
         datestart = request.form['datestart']
         datend = request.form['datend']
 
-        price = Prices.query.filter_by(zoneid=zone_id).first()
+        price = price_table.get(zone_id)
+        if price is None:
+            return render_template('users/order-noprice.html')
 
         # We are booking the campaign in Revive, but turning off by default
         # until payment is confirmed
@@ -619,14 +609,18 @@ def order():
             enddate = datetime.strptime(datend, "%d/%m/%Y")
         except BaseException:
             return render_template('users/date-problems.html')
-        totaltime = enddate - begin
+        if enddate < begin:
+            return render_template('users/date-problems.html')
+        # a quick check before asking Revive, `book` checks again under a lock
+        if not is_free(zone_id, begin, enddate):
+            return render_template('users/date-problems.html', taken=True)
         diki = {}
         diki['advertiserId'] = advertiser_id
         diki['campaignName'] = randomname
         diki['startDate'] = begin
         diki['endDate'] = enddate
         diki['comments'] = zone_name
-        campaign = r.ox.addCampaign(sessionid, diki)
+        campaign = revive.ox.addCampaign(diki)
 
         # Now we are adding our banner to campaign
         diki = {}
@@ -637,14 +631,14 @@ def order():
         diki['height'] = height
         diki['url'] = url
         diki['storageType'] = 'url'
-        r.ox.addBanner(sessionid, diki)
+        revive.ox.addBanner(diki)
 
-        Orders.create(
+        booked = book(
+            zone_id,
+            begin,
+            enddate,
             campaigno=campaign,
-            zoneid=zone_id,
             created_at=datetime.utcnow(),
-            begins_at=begin,
-            stops_at=enddate,
             paymentno=0,
             bannerid=banner_id,
             name=randomname,
@@ -652,6 +646,11 @@ def order():
             impressions=0,
             user_id=current_user.id
         )
+        if booked is None:
+            # somebody else was faster
+            revive.ox.deleteCampaign(campaign)
+            return render_template('users/date-problems.html', taken=True)
+        bump_data_version('orders')
 
         dblogger(
             current_user.id,
@@ -670,6 +669,7 @@ def order():
             campaigno=campaign,
             user_id=current_user.id
         )
+        forget_basket_count()
 
         return render_template(
             'users/order.html',
@@ -679,7 +679,7 @@ def order():
             datend=datend,
             image_url=image_url,
             zone_id=zone_id,
-            days=totaltime.days,
+            days=campaign_days(begin, enddate),
             dayprice=price.dayprice,
             step='order'
         )
@@ -690,27 +690,15 @@ def order():
 def basket():
     """Present his/her basket to customer."""
 
-    basket = []
-    price = []
-    totalprice = 0
-    basket_sql = Basket.query.filter_by(user_id=current_user.id).all()
+    basket = basket_items(current_user.id)
     # Checks to see if the user has already started a cart.
-    if basket_sql:
-        for item in basket_sql:
-            order_sql = Orders.query.filter_by(
-                campaigno=item.campaigno).join(Banner).join(Prices).add_columns(
-                Banner.filename, Banner.url, Banner.width, Banner.height,
-                    Banner.content, Banner.icon, Banner.type, Prices.dayprice).first()
-            basket.append(order_sql)
-            begin = order_sql[0].begins_at
-            enddate = order_sql[0].stops_at
-            campaign_time = enddate - begin
-            currencyprice = order_sql.dayprice/100*(campaign_time.days+1)
-            price.append([item.campaigno, currencyprice])
-            totalprice += currencyprice
+    if basket:
+        price = [[item[0].campaigno, item.line_total] for item in basket]
+        totalprice = sum(item.line_total for item in basket)
     else:
         basket = 0
         price = 0
+        totalprice = 0
 
     return render_template(
         'users/basket.html',
@@ -747,35 +735,33 @@ def clear_banner(banner_id):
 @login_required
 def clear_basket(campaign_id):
     try:
-        r = xmlrpc.client.ServerProxy(
-            current_app.config.get('REVIVE_XML_URI'),
-            verbose=False
-        )
-        sessionid = session['revive']
         if campaign_id == 0:
             all_basket = Basket.query.filter_by(user_id=current_user.id).all()
             # Removing these campaigns from Revive as not useful in future
             Basket.query.filter_by(user_id=current_user.id).delete()
-            for order in all_basket:
-                try:
-                    removed = r.ox.deleteCampaign(sessionid, order.campaigno)
+            all_removed = revive.batch(
+                (('ox.deleteCampaign', (order.campaigno,)) for order in all_basket),
+                return_exceptions=True
+            )
+            for order, removed in zip(all_basket, all_removed):
+                if isinstance(removed, Exception):
+                    log.info(
+                        "Campaign %s was not removed from Revive because it was not found in there. It can be an error or you removed it manually before in Revive interface." % (
+                            str(order.campaigno)
+                            )
+                    )
+                else:
                     log.debug(
                         "Campaign #%s removed from Revive?: %s" % (
                             str(order.campaigno),
                             str(removed)
                             )
                     )
-                except:
-                    log.info(
-                        "Campaign %s was not removed from Revive because it was not found in there. It can be an error or you removed it manually before in Revive interface." % (
-                            str(order.campaigno)
-                            )
-                    )
                 Orders.query.filter_by(campaigno=order.campaigno).delete()
                 flash('Your basket was removed sucessfully.', 'success')
         else:
             try:
-                removed = r.ox.deleteCampaign(sessionid, campaign_id)
+                removed = revive.ox.deleteCampaign(campaign_id)
                 log.debug(
                     "Campaign #%s removed from Revive?: %s" % (
                             str(campaign_id),
@@ -793,6 +779,8 @@ def clear_basket(campaign_id):
             flash('Your planned campaign was removed sucessfully.', 'success')
         Basket.commit()
         Orders.commit()
+        bump_data_version('orders')
+        forget_basket_count()
     except Exception as e:
         log.debug("Exception")
         log.exception(e)
@@ -805,11 +793,6 @@ def clear_basket(campaign_id):
 @login_required
 def clear_campaign(campaign_no):
     try:
-        r = xmlrpc.client.ServerProxy(
-            current_app.config.get('REVIVE_XML_URI'),
-            verbose=False
-        )
-        sessionid = session['revive']
 
         # getting data about this campaign 
         # and confirming it belongs to the user
@@ -820,7 +803,8 @@ def clear_campaign(campaign_no):
         # removing campaign from all sources
         Orders.query.filter_by(campaigno=campaign_no).delete()
         Orders.commit()
-        removed = r.ox.deleteCampaign(sessionid, campaign_no)
+        bump_data_version('orders')
+        removed = revive.ox.deleteCampaign(campaign_no)
         logdata = (
             "Campaign #{} removed from Revive?: {}".format(
                 campaign_no,
@@ -859,38 +843,25 @@ def pay():
         return render_template('users/paymentsystem-problems.html')
 
     # first we need to get basket data
-    basket = []
-    total = 0
-    cointotal = 0
     label = "%s ※ %s ※ " % (
         current_app.config.get('USER_APP_NAME'),
         current_user.username)
-    basket_sql = Basket.query.filter_by(user_id=current_user.id).all()
+    basket = basket_items(current_user.id)
     # Checks to see if the user has already started a cart.
-    if basket_sql:
-        for item in basket_sql:
-            order_sql = Orders.query.filter_by(
-                campaigno=item.campaigno).join(Banner).join(Prices).add_columns(
-                Banner.filename, Banner.url, Banner.width, Banner.height, Prices.dayprice).first()
-            basket.append(order_sql)
-            begin = order_sql[0].begins_at
-            enddate = order_sql[0].stops_at
-            totaltime = enddate - begin
-            totalcurrencyprice = order_sql.dayprice/100*(totaltime.days+1)
-            total += totalcurrencyprice
-            label = label + "[C#{} Z#{} B#{} {} ↦ {} {:.2f}{}] ※ ".format(
-                item.campaigno,
-                order_sql[0].zoneid,
-                order_sql[0].bannerid,
-                begin.strftime("%d/%m/%y"),
-                enddate.strftime("%d/%m/%y"),
-                totalcurrencyprice,
-                current_app.config.get('FIAT')
-            )
-    else:
-        basket = 0
+    if not basket:
         log.error("Trying to pay for empty basket.")
         return redirect(url_for("user.basket"), code=302)
+    total = sum(item.line_total for item in basket)
+    for item in basket:
+        label = label + "[C#{} Z#{} B#{} {} ↦ {} {:.2f}{}] ※ ".format(
+            item[0].campaigno,
+            item[0].zoneid,
+            item[0].bannerid,
+            item[0].begins_at.strftime("%d/%m/%y"),
+            item[0].stops_at.strftime("%d/%m/%y"),
+            item.line_total,
+            current_app.config.get('FIAT')
+        )
 
     randomid = str(uuid.uuid4())
     buyer = {
@@ -916,8 +887,9 @@ def pay():
     btcpayinv = btcpayclient.create_invoice(btcpayinvreq)
     log.debug(pprint.pformat(btcpayinv, depth=5))
 
-    # Creating database record for payment and linking it into orders.
-    payment_sql = Payments.create(
+    # Creating database record for payment and linking it into orders,
+    # all in one transaction.
+    payment_sql = Payments(
         created_at=datetime.utcnow(),
         user_id=current_user.id,
         btcpayserver_id=btcpayinv['id'],
@@ -927,16 +899,19 @@ def pay():
         fiat_amount=btcpayinv['price'],
         posdata=randomid,
     )
+    db.session.add(payment_sql)
     # we need payment numer id to properly relate tables
+    db.session.flush()
     paymentno = payment_sql.id
 
-    for item in basket:
-        Orders.query.filter_by(campaigno=item[0].campaigno).update({"paymentno": paymentno})
-        Orders.commit()
+    Orders.query.filter(
+        Orders.campaigno.in_([item[0].campaigno for item in basket])
+    ).update({"paymentno": paymentno}, synchronize_session=False)
 
     # It looks that payment page is ready to be shown, so we remove the content of basket
     Basket.query.filter_by(user_id=current_user.id).delete()
-    Basket.commit()
+    db.session.commit()
+    forget_basket_count()
 
     # redirect to payment page
     return redirect(btcpayinv['url'], code=302)
@@ -1005,12 +980,73 @@ def listusers():
     )
 
 
-# TODO: paging of data
+@blueprint.route('/admin/jobs')
+@roles_accepted('admin')
+def jobs():
+    """Scheduled jobs, how long they take and how they end."""
+    return render_template(
+        'users/jobs.html',
+        jobs=job_status()
+    )
+
+
+@blueprint.route('/admin/jobs.json')
+@roles_accepted('admin')
+def jobs_json():
+    return jsonify(job_status())
+
+
+def heatmap_window():
+    """Window of the heatmap from `start`/`end`, by default a month back and two ahead."""
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    start = calendar_day(request.args.get('start'), today - timedelta(days=30))
+    end = calendar_day(request.args.get('end'), today + timedelta(days=60))
+    return start, max(end, start)
+
+
+@blueprint.route('/admin/heatmap')
+@roles_accepted('admin')
+def occupancy_heatmap():
+    """Which zones are booked on which days, and for how much."""
+    start, end = heatmap_window()
+    # a page can show about a quarter, longer windows are for the JSON
+    end = min(end, start + timedelta(days=91))
+    return render_template(
+        'users/heatmap.html',
+        heatmap=heatmap(start, end)
+    )
+
+
+@blueprint.route('/admin/heatmap.json')
+@roles_accepted('admin')
+def occupancy_heatmap_json():
+    return jsonify(heatmap(*heatmap_window()))
+
+
+@blueprint.route('/admin/db-pool.json')
+@roles_accepted('admin')
+def db_pool_json():
+    """SQL connection pool of this worker process."""
+    return jsonify(pool_status())
+
+
 @blueprint.route('/admin/log/<int:user_id>')
 @roles_accepted('admin')
 def logaboutuser(user_id):
-    userlog = Log.query.filter_by(user_id=user_id).all()
+    userlog, older = log_page(user_id, request.args.get('before'))
     return render_template(
         'users/logaboutuser.html',
-        userlog=userlog
+        userlog=userlog,
+        user_id=user_id,
+        older=older
+    )
+
+
+@blueprint.route('/admin/log/<int:user_id>.csv')
+@roles_accepted('admin')
+def logaboutuser_csv(user_id):
+    return Response(
+        stream_with_context(export_csv(user_id)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=log-{}.csv'.format(user_id)}
     )
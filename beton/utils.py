@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 """Helper utilities and decorators."""
 
-from datetime import datetime
+import uuid
 
-from flask import current_app, flash
+from flask import flash
+from sqlalchemy.exc import IntegrityError
 
-from beton.logger import log
-from beton.user.models import Log
+from beton.extensions import db, dblog
+from beton.user.models import DataVersion
 
 
 def flash_errors(form, category='warning'):
@@ -15,18 +16,35 @@ def flash_errors(form, category='warning'):
         for error in errors:
             flash('{0} - {1}'.format(getattr(form, field).label.text, error), category)
 
-def reviveme(r):
-    sessionid = r.ox.logon(current_app.config.get('REVIVE_MASTER_USER'),
-                           current_app.config.get('REVIVE_MASTER_PASSWORD'))
-    return sessionid
-
 def dblogger(userid, logdata):
-    """Logging main events to database."""
-    try:
-        Log.create(
-            user_id=userid,
-            datelog=datetime.utcnow(),
-            logdata=logdata
-        )
-    except Exception as e:
-        log.exception(e)
+    """Logging main events to database, in the background (see beton.dblog)."""
+    dblog.write(userid, logdata)
+
+
+def data_version(name):
+    """Stamp of a kind of data, which changes with `bump_data_version`.
+
+    It is kept in the database, so all workers see the same one and anything
+    derived from that data can be cached under it, also in per-process caches.
+    It is None until the data is bumped for the first time.
+    """
+    return db.session.query(DataVersion.version).filter(DataVersion.name == name).scalar()
+
+
+def bump_data_version(name):
+    """Make everything cached under the current stamp stale; it commits.
+
+    Stamps are random, so none of them is ever used twice.
+    """
+    version = uuid.uuid4().hex
+    for _ in range(2):
+        if DataVersion.query.filter(DataVersion.name == name).update(
+                {DataVersion.version: version}, synchronize_session=False):
+            db.session.commit()
+            return
+        try:
+            DataVersion.create(name=name, version=version)
+            return
+        except IntegrityError:
+            # another worker created it in the meantime
+            db.session.rollback()
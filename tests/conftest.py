@@ -6,6 +6,8 @@ from webtest import TestApp
 
 from beton.app import create_app
 from beton.database import db as _db
+from beton.extensions import cache, revive
+from beton.fakerevive import FakeReviveServer
 from beton.settings import TestConfig
 
 from .factories import UserFactory
@@ -43,6 +45,20 @@ def db(app):
     _db.drop_all()
 
 
+@pytest.yield_fixture(scope='function')
+def fake_revive(app):
+    """A local stand-in for Revive, used by the app for the test."""
+    server = FakeReviveServer().start()
+    app.config['REVIVE_XML_URI'] = server.uri
+    app.config['REVIVE_MASTER_USER'] = server.revive.username
+    app.config['REVIVE_MASTER_PASSWORD'] = server.revive.password
+    revive.init_app(app, cache)
+
+    yield server.revive
+
+    server.stop()
+
+
 @pytest.fixture
 def user(db):
     """A user for the tests."""
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 """Factories to help in tests."""
-from factory import PostGenerationMethodCall, Sequence
+import datetime as dt
+
+from factory import LazyFunction, PostGenerationMethodCall, SelfAttribute, Sequence
 from factory.alchemy import SQLAlchemyModelFactory
 
 from beton.database import db
-from beton.user.models import User
+from beton.user.models import Banner, Orders, Payments, User
 
 
 class BaseFactory(SQLAlchemyModelFactory):
@@ -29,3 +31,65 @@ class UserFactory(BaseFactory):
         """Factory configuration."""
 
         model = User
+
+
+class BannerFactory(BaseFactory):
+    """Image banner factory."""
+
+    filename = Sequence(lambda n: 'banner{0}.png'.format(n))
+    owner = 1
+    created_at = LazyFunction(dt.datetime.utcnow)
+    url = 'https://example.com'
+    height = 60
+    width = 468
+    comments = ''
+    type = 'image'
+    content = ''
+    icon = ''
+
+    class Meta:
+        """Factory configuration."""
+
+        model = Banner
+        sqlalchemy_session_persistence = 'commit'
+
+
+class PaymentFactory(BaseFactory):
+    """Payment factory, paid when it was created unless told otherwise."""
+
+    fiat = 'EUR'
+    fiat_amount = 1
+    created_at = LazyFunction(dt.datetime.utcnow)
+    posdata = Sequence(lambda n: 'posdata{0}'.format(n))
+    received_at = SelfAttribute('created_at')
+    confirmed_at = SelfAttribute('received_at')
+    btcpayserver_id = Sequence(lambda n: 'invoice{0}'.format(n))
+    user_id = 1
+
+    class Meta:
+        """Factory configuration."""
+
+        model = Payments
+        sqlalchemy_session_persistence = 'commit'
+
+
+class OrderFactory(BaseFactory):
+    """Order factory, a one day campaign starting when it was created."""
+
+    campaigno = Sequence(lambda n: n + 1)
+    zoneid = 1
+    created_at = LazyFunction(dt.datetime.utcnow)
+    begins_at = SelfAttribute('created_at')
+    stops_at = SelfAttribute('begins_at')
+    paymentno = None
+    bannerid = 1
+    name = 'test'
+    comments = ''
+    impressions = 0
+    user_id = 1
+
+    class Meta:
+        """Factory configuration."""
+
+        model = Orders
+        sqlalchemy_session_persistence = 'commit'
@@ -3,11 +3,26 @@
 
 See: http://webtest.readthedocs.org/
 """
+import datetime as dt
+
+import pytest
 from flask import url_for
+from flask_security.utils import hash_password
 
+from beton.extensions import user_datastore
 from beton.user.models import User
 
-from .factories import UserFactory
+from .factories import OrderFactory, UserFactory
+
+
+@pytest.fixture
+def advertiser(db, testapp):
+    """A confirmed user, logged in to the testapp."""
+    user = user_datastore.create_user(username='advertiser', email='advertiser@example.com',
+                                      password=hash_password('myprecious'), confirmed_at=dt.datetime.utcnow())
+    db.session.commit()
+    testapp.post(url_for('security.login'), {'email': user.email, 'password': 'myprecious'})
+    return user
 
 
 class TestLoggingIn:
@@ -118,3 +133,15 @@ class TestRegistering:
         res = form.submit()
         # sees error
         assert 'Username already registered' in res
+
+
+class TestCalendar:
+    """Campaigns for the calendars."""
+
+    def test_etag(self, advertiser, testapp):
+        """An unchanged calendar is not sent again."""
+        OrderFactory(campaigno=1, begins_at=dt.datetime(2020, 1, 1), stops_at=dt.datetime(2020, 1, 6), paymentno=1)
+        url = url_for('user.api_all_campaigns', zone_id=1, start='2020-01-01', end='2020-02-01')
+        res = testapp.get(url)
+        assert res.status_code == 200
+        assert testapp.get(url, headers={'If-None-Match': res.headers['ETag']}, status=304)
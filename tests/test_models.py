@@ -1,12 +1,26 @@
 # -*- coding: utf-8 -*-
 """Model unit tests."""
 import datetime as dt
+import json
 
 import pytest
+from flask import Flask
+from sqlalchemy import create_engine
 
-from beton.user.models import Role, User
+from beton.database import upsert
+from beton.dbpool import TimedQueuePool, configure_engine, pool_metrics
+from beton.extensions import dblog
+from beton.user.availability import book, booked_days, campaign_days, free_days, is_free
+from beton.user.campaigns import CampaignRow, campaign_page, campaigns_json
+from beton.user.heatmap import heatmap
+from beton.user.logs import archive_logs, export_csv, log_page
+from beton.user.models import Basket, Impressions, Log, LogArchive, Orders, Prices, Role, StatsFact, User
+from beton.user.prices import price_table, prices_changed
+from beton.user.timeseries import record, series
+from beton.user.views import basket_items, calendar_events, campaign_color
+from beton.utils import bump_data_version, data_version, dblogger
 
-from .factories import UserFactory
+from .factories import BannerFactory, OrderFactory, PaymentFactory, UserFactory
 
 
 @pytest.mark.usefixtures('db')
@@ -65,3 +79,304 @@ class TestUser:
         user.roles.append(role)
         user.save()
         assert role in user.roles
+
+
+@pytest.mark.usefixtures('db')
+class TestUpsert:
+    """Bulk upsert."""
+
+    def test_inserts_and_updates(self, db):
+        """Existing rows are updated and new ones inserted."""
+        Impressions.create(zoneid=1, impressions=5, clicks=0)
+        upsert(Impressions, [{'zoneid': 1, 'impressions': 10, 'clicks': 1},
+                             {'zoneid': 2, 'impressions': 20, 'clicks': 2}], ['zoneid'])
+        db.session.commit()
+        rows = db.session.query(Impressions.zoneid, Impressions.impressions).order_by(Impressions.zoneid)
+        assert [tuple(row) for row in rows] == [(1, 10), (2, 20)]
+
+
+@pytest.mark.usefixtures('db')
+class TestTimeseries:
+    """Hourly facts and rollups of impressions."""
+
+    def test_hourly_deltas_and_rollups(self, db):
+        """Growth of daily totals goes to the hour in which it was seen."""
+        kind = StatsFact.KIND_ZONE
+        morning = dt.datetime(2026, 3, 31, 9, 30)
+        record(kind, {(7, morning.date()): (100, 4)}, morning)
+        record(kind, {(7, morning.date()): (150, 5)}, morning + dt.timedelta(hours=3))
+        # repeating the same hour does not count twice
+        record(kind, {(7, morning.date()): (150, 5)}, morning + dt.timedelta(hours=3))
+        db.session.commit()
+
+        hours = series(kind, 7, morning.replace(hour=0), morning.replace(hour=23), 'hour')
+        assert [(p['time'].hour, p['impressions']) for p in hours] == [(9, 100), (12, 50)]
+        days = series(kind, 7, morning, morning, 'day')
+        assert (days[0]['impressions'], days[0]['clicks']) == (150, 5)
+        assert days[0]['ctr'] == pytest.approx(5 / 150)
+        months = series(kind, 7, morning, morning, 'month')
+        assert months[0]['time'] == dt.datetime(2026, 3, 1)
+        assert months[0]['impressions'] == 150
+
+
+@pytest.mark.usefixtures('db')
+class TestBasket:
+    """Basket loaded in one query."""
+
+    def test_line_totals(self):
+        """Campaign prices are computed in SQL, for whole days."""
+        begins = dt.datetime(2026, 5, 1)
+        Prices.create(zoneid=3, dayprice=250, x0=0, x1=0, y0=0, y1=0)
+        banner = BannerFactory(filename='b.png')
+        for campaigno, days in ((1, 0), (2, 6)):
+            OrderFactory(campaigno=campaigno, zoneid=3, begins_at=begins,
+                         stops_at=begins + dt.timedelta(days=days, hours=5), bannerid=banner.id)
+            Basket.create(user_id=1, campaigno=campaigno)
+        items = basket_items(1)
+        assert [(item[0].campaigno, item.line_total) for item in items] == [(1, 2.5), (2, 17.5)]
+        assert all(type(item.line_total) is float for item in items)
+        assert items[0].filename == 'b.png'
+
+
+@pytest.mark.usefixtures('db')
+class TestCampaignList:
+    """Campaign list read in pages."""
+
+    @staticmethod
+    def campaigns(count, now):
+        banner = BannerFactory()
+        payment = PaymentFactory(fiat_amount=10, created_at=now)
+        for campaigno in range(1, count + 1):
+            OrderFactory(campaigno=campaigno, begins_at=now, stops_at=now + dt.timedelta(days=campaigno % 3),
+                         paymentno=payment.id, bannerid=banner.id, user_id=1 if campaigno != 7 else 2)
+
+    def test_pages(self):
+        """Pages are sorted by end and do not overlap."""
+        now = dt.datetime(2020, 1, 1)
+        self.campaigns(7, now)
+        seen, cursor = [], None
+        while True:
+            rows, cursor = campaign_page(now - dt.timedelta(days=1), user_id=1, cursor=cursor, size=2)
+            assert all(isinstance(row, CampaignRow) for row in rows)
+            seen.extend(row.campaigno for row in rows)
+            if cursor is None:
+                break
+        assert seen == [5, 2, 4, 1, 6, 3]
+
+    def test_json(self):
+        """The streamed JSON has all campaigns of all users."""
+        now = dt.datetime(2020, 1, 1)
+        self.campaigns(7, now)
+        campaigns = json.loads(''.join(campaigns_json(now - dt.timedelta(days=1), chunk=3)))
+        assert len(campaigns) == 7
+        assert campaigns[0]['fiat_amount'] == '10.00000000'
+        assert campaigns[0]['stops_at'] == '2020-01-03T00:00:00'
+
+
+@pytest.mark.usefixtures('db')
+class TestLog:
+    """Admin log writer."""
+
+    def test_sync(self):
+        """Without DBLOG_ASYNC a row is written at once."""
+        dblogger(1, 'written now')
+        assert Log.query.one().logdata == 'written now'
+
+    def test_async_batches(self, app):
+        """Queued rows are written in batches and on close."""
+        app.config.update(DBLOG_ASYNC=True, DBLOG_BATCH=2, DBLOG_INTERVAL=60)
+        try:
+            for number in range(3):
+                dblogger(1, 'row {}'.format(number))
+            assert dblog.flush(timeout=5)
+            assert Log.query.count() == 3
+            dblogger(1, 'row 3')
+        finally:
+            dblog.close()
+        assert Log.query.count() == 4
+
+    @staticmethod
+    def rows(count, now):
+        for number in range(count):
+            Log.create(user_id=1, datelog=now - dt.timedelta(days=number), logdata='row {}'.format(number))
+
+    def test_pages(self):
+        """Pages follow each other newest first, without gaps."""
+        self.rows(5, dt.datetime(2020, 1, 10))
+        Log.create(user_id=1, datelog=dt.datetime(2020, 1, 10), logdata='same time')
+        seen, cursor = [], None
+        while True:
+            rows, cursor = log_page(1, cursor, size=2)
+            seen.extend(row.logdata for row in rows)
+            if cursor is None:
+                break
+        assert seen == ['same time', 'row 0', 'row 1', 'row 2', 'row 3', 'row 4']
+
+    def test_export(self):
+        """The CSV has a header and all rows."""
+        self.rows(3, dt.datetime(2020, 1, 10))
+        lines = ''.join(export_csv(1, chunk=2)).splitlines()
+        assert lines[0] == 'id,datelog,logdata'
+        assert len(lines) == 4
+
+    def test_archive(self):
+        """Only old rows are moved."""
+        self.rows(5, dt.datetime.utcnow() + dt.timedelta(hours=1))
+        assert archive_logs(days=2, chunk=1) == 2
+        assert Log.query.count() == 3
+        assert sorted(row.logdata for row in LogArchive.query) == ['row 3', 'row 4']
+
+
+@pytest.mark.usefixtures('db')
+class TestCalendar:
+    """Campaigns for the calendars."""
+
+    @staticmethod
+    def order(campaigno, zoneid, begins_at, days):
+        OrderFactory(campaigno=campaigno, zoneid=zoneid, begins_at=begins_at,
+                     stops_at=begins_at + dt.timedelta(days=days), paymentno=1)
+
+    def test_window(self):
+        """Only campaigns of the zone overlapping the window are sent."""
+        self.order(1, 1, dt.datetime(2020, 1, 1), 5)
+        self.order(2, 1, dt.datetime(2020, 3, 1), 5)
+        self.order(3, 2, dt.datetime(2020, 1, 1), 5)
+        body, etag = calendar_events(1, dt.datetime(2020, 1, 3), dt.datetime(2020, 2, 1))
+        assert [event['id'] for event in json.loads(body)] == [1]
+        assert json.loads(body)[0]['color'] == campaign_color(1)
+        body, _ = calendar_events(0, dt.datetime(2020, 1, 3), dt.datetime(2020, 2, 1))
+        assert [event['id'] for event in json.loads(body)] == [1, 3]
+
+
+@pytest.mark.usefixtures('db')
+class TestAvailability:
+    """Free days of zones."""
+
+    def test_free_days(self):
+        """Days of campaigns in the zone are taken, both ends included."""
+        TestCalendar.order(1, 1, dt.datetime(2020, 1, 2), 2)
+        TestCalendar.order(2, 1, dt.datetime(2020, 1, 6), 0)
+        TestCalendar.order(3, 2, dt.datetime(2020, 1, 1), 30)
+        start, end = dt.datetime(2020, 1, 1), dt.datetime(2020, 1, 7)
+        assert [day.day for day in booked_days(1, start, end)] == [2, 3, 4, 6]
+        assert [day.day for day in free_days(1, start, end)] == [1, 5, 7]
+
+    def test_is_free(self):
+        """Overlapping bookings are found."""
+        TestCalendar.order(1, 1, dt.datetime(2020, 1, 2), 2)
+        assert is_free(1, dt.datetime(2020, 1, 5), dt.datetime(2020, 1, 9))
+        assert not is_free(1, dt.datetime(2020, 1, 4), dt.datetime(2020, 1, 9))
+        assert not is_free(1, dt.datetime(2019, 12, 1), dt.datetime(2020, 2, 1))
+        assert is_free(2, dt.datetime(2020, 1, 4), dt.datetime(2020, 1, 9))
+
+    def test_book(self):
+        """An order is created only on free days, which are also paid for."""
+        Prices.create(zoneid=1, dayprice=100, x0=0, x1=0, y0=0, y1=0)
+        begins_at, stops_at = dt.datetime(2020, 1, 2), dt.datetime(2020, 1, 4)
+        order = dict(created_at=begins_at, paymentno=0, bannerid=1, name='x',
+                     comments='', impressions=0, user_id=1)
+        assert book(1, begins_at, stops_at, campaigno=1, **order) is not None
+        assert book(1, stops_at, stops_at, campaigno=2, **order) is None
+        assert Orders.query.count() == 1
+        assert campaign_days(begins_at, stops_at) == len(booked_days(1, begins_at, stops_at)) == 3
+
+
+@pytest.mark.usefixtures('db')
+class TestHeatmap:
+    """Occupancy of zones by day."""
+
+    def test_occupancy(self):
+        """Paid campaigns count on their days, clipped to the window."""
+        now = dt.datetime(2020, 1, 1)
+        for zoneid, dayprice in ((1, 100), (2, 300)):
+            Prices.create(zoneid=zoneid, dayprice=dayprice, x0=0, x1=0, y0=0, y1=0)
+        paid = PaymentFactory(created_at=now)
+        unpaid = PaymentFactory(created_at=now, received_at=dt.datetime.min)
+        for campaigno, zoneid, day, days, payment in ((1, 1, 0, 2, paid), (2, 2, 3, 9, paid),
+                                                      (3, 1, 1, 0, paid), (4, 1, 4, 0, unpaid)):
+            OrderFactory(campaigno=campaigno, zoneid=zoneid, begins_at=now + dt.timedelta(days=day),
+                         stops_at=now + dt.timedelta(days=day + days), paymentno=payment.id)
+        result = heatmap(now + dt.timedelta(days=1), now + dt.timedelta(days=4))
+        assert result['days'][0] == '2020-01-02'
+        assert result['occupancy'] == [[2, 1, 0, 0], [0, 0, 1, 1]]
+        assert [zone['revenue'] for zone in result['zones']] == [300, 600]
+        assert result['fill_rate'] == 0.5
+
+    def test_recomputed_after_bump(self):
+        """A cached heatmap is used until the version of orders changes."""
+        now = dt.datetime(2020, 1, 1)
+        Prices.create(zoneid=1, dayprice=100, x0=0, x1=0, y0=0, y1=0)
+        paid = PaymentFactory(created_at=now)
+        assert heatmap(now, now)['occupancy'] == [[0]]
+        OrderFactory(campaigno=1, begins_at=now, paymentno=paid.id)
+        assert heatmap(now, now)['occupancy'] == [[0]]
+        version = data_version('orders')
+        bump_data_version('orders')
+        assert data_version('orders') != version
+        assert heatmap(now, now)['occupancy'] == [[1]]
+
+
+@pytest.mark.usefixtures('db')
+class TestPrices:
+    """Prices kept in the worker."""
+
+    def test_reloaded_after_change(self):
+        """Prices are read from the dict until their version changes."""
+        prices_changed()
+        price = Prices.create(zoneid=1, dayprice=100, x0=0, x1=10, y0=0, y1=10)
+        assert price_table.get(1).dayprice == 100
+        assert price_table.get(2) is None
+        price.update(dayprice=200)
+        assert price_table.get(1).dayprice == 100
+        prices_changed()
+        assert price_table.get(1).dayprice == 200
+
+    def test_new_zone_without_bump(self):
+        """A zone priced after the table was loaded is found in the database."""
+        prices_changed()
+        assert price_table.get(1) is None
+        Prices.create(zoneid=1, dayprice=100, x0=0, x1=10, y0=0, y1=10)
+        assert price_table.get(1).dayprice == 100
+
+    def test_without_stamp(self):
+        """Prices are read from the database until they get a version stamp."""
+        price = Prices.create(zoneid=1, dayprice=100, x0=0, x1=10, y0=0, y1=10)
+        assert price_table.get(1).dayprice == 100
+        price.update(dayprice=200)
+        assert data_version('prices') is None
+        assert price_table.get(1).dayprice == 200
+
+    def test_forgotten_by_new_app(self, app):
+        """A new app does not use prices loaded from the database of another one."""
+        prices_changed()
+        price = Prices.create(zoneid=1, dayprice=100, x0=0, x1=10, y0=0, y1=10)
+        assert price_table.get(1).dayprice == 100
+        price.update(dayprice=200)
+        price_table.init_app(app)
+        assert price_table.get(1).dayprice == 200
+
+
+class TestPool:
+    """Connection pool with metrics."""
+
+    def test_metrics(self):
+        """Checkouts, waiting and new connections are counted."""
+        pool_metrics.reset()
+        engine = create_engine('sqlite://', poolclass=TimedQueuePool, pool_size=1, max_overflow=0)
+        for _ in range(3):
+            engine.execute('SELECT 1')
+        metrics = pool_metrics.snapshot()
+        assert metrics['checkouts'] == 3
+        assert metrics['connects'] == 1
+        assert metrics['wait_max_ms'] >= 0
+
+    def test_defaults_only_for_servers(self):
+        """SQLite keeps its own pool, other databases get the tuned one."""
+        app = Flask(__name__)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://beton@localhost/beton'
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 3}
+        configure_engine(app)
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        assert options['pool_pre_ping'] is True
+        assert options['pool_size'] == 3
+        assert options['poolclass'] is TimedQueuePool
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""Revive client tests."""
+import socket
+import xmlrpc.client
+from datetime import datetime, timedelta
+
+import pytest
+
+from beton.extensions import revive
+from beton.revive import (CircuitBreaker, PooledSafeTransport, PooledTransport, PoolExhausted, ReviveUnavailable,
+                          TransportPool)
+from beton.user.advertisers import backfill_advertisers, provision_advertiser
+from beton.user.availability import is_free
+from beton.user.cleanup import remove_unpaid
+from beton.user.inventory import get_zones
+from beton.user.models import Basket, Impressions, Log, Orders, Payments, StatsFact, User
+from beton.user.stats import sync_campaign_stats, sync_zone_stats
+from beton.user.timeseries import series
+
+from .factories import OrderFactory, PaymentFactory
+
+
+class TestTransportPool:
+    """Pool of keep-alive transports."""
+
+    def test_picks_transport_by_scheme(self):
+        """TLS is used only for https URIs."""
+        assert isinstance(TransportPool('http://revive/x').acquire(), PooledTransport)
+        assert isinstance(TransportPool('https://revive/x').acquire(), PooledSafeTransport)
+
+    def test_reuses_released_transport(self):
+        """A released transport is handed out again."""
+        pool = TransportPool('http://revive/x', size=1)
+        transport = pool.acquire()
+        pool.release(transport)
+        assert pool.acquire() is transport
+
+    def test_is_bounded(self):
+        """No more transports than the pool size are created."""
+        pool = TransportPool('http://revive/x', size=1, wait=0.01)
+        pool.acquire()
+        with pytest.raises(RuntimeError):
+            pool.acquire()
+
+    def test_broken_transport_is_replaced(self):
+        """A broken transport frees its slot for a new one."""
+        pool = TransportPool('http://revive/x', size=1, wait=0.01)
+        transport = pool.acquire()
+        pool.release(transport, broken=True)
+        assert pool.acquire() is not transport
+
+
+class TestRevive:
+    """Revive client against the fake Revive."""
+
+    def test_session_is_shared(self, fake_revive):
+        """Only one logon is needed for many calls."""
+        revive.ox.getPublisherListByAgencyId(1)
+        revive.ox.getPublisherListByAgencyId(1)
+        assert fake_revive.calls.count('ox.logon') == 1
+
+    def test_session_is_renewed_after_fault(self, fake_revive):
+        """An expired session is replaced and the call repeated."""
+        revive.ox.getAgency(1)
+        fake_revive.expire_sessions()
+        assert revive.ox.getAgency(1)['agencyId'] == 1
+        assert fake_revive.calls.count('ox.logon') == 2
+
+    def test_other_faults_are_not_repeated(self, fake_revive):
+        """A write refused by Revive is sent only once, in the same session."""
+        revive.ox.getAgency(1)
+        with pytest.raises(xmlrpc.client.Fault):
+            revive.ox.deleteCampaign(999)
+        assert fake_revive.calls.count('ox.deleteCampaign') == 1
+        assert fake_revive.calls.count('ox.logon') == 1
+
+    def test_batch_uses_multicall(self, fake_revive):
+        """Batched calls are sent in one request."""
+        zonelists = revive.batch(
+            ('ox.getZoneListByPublisherId', (publisher_id,)) for publisher_id in (1, 2))
+        assert [zones[0]['publisherId'] for zones in zonelists] == [1, 2]
+        assert 'system.multicall' in fake_revive.calls
+
+    def test_batch_timeout_adds_slow_methods(self, app, fake_revive, monkeypatch):
+        """A multicall waits as long as its slow methods take one after another."""
+        app.config['REVIVE_TIMEOUTS'] = {'ox.agencyZoneStatistics': 120}
+        revive.sessionid()
+        timeouts = []
+        send = revive._send
+        monkeypatch.setattr(revive, '_send', lambda method, *args: timeouts.append(args[1]) or send(method, *args))
+        revive.batch([('ox.agencyZoneStatistics', (1, datetime.utcnow(), datetime.utcnow()))] * 3)
+        revive.batch([('ox.getAgency', (1,))] * 3)
+        assert timeouts == [360, 30]
+
+    def test_batch_returns_exceptions(self, fake_revive):
+        """A failed call does not hide results of other calls."""
+        results = revive.batch([('ox.getZoneListByPublisherId', (1,)),
+                                ('ox.getZoneListByPublisherId', (999,))],
+                               return_exceptions=True)
+        assert len(results[0]) == 3
+        assert isinstance(results[1], xmlrpc.client.Fault)
+
+    def test_parallel_batch_keeps_order(self, app, fake_revive):
+        """Without multicall calls run concurrently and give results in order."""
+        app.config['REVIVE_MULTICALL'] = False
+        zonelists = revive.batch([('ox.getZoneListByPublisherId', (2,)), ('ox.getZoneListByPublisherId', (1,))])
+        assert [zones[0]['publisherId'] for zones in zonelists] == [2, 1]
+        assert 'system.multicall' not in fake_revive.calls
+
+
+class TestCircuitBreaker:
+    """Circuit breaker."""
+
+    def test_opens_after_threshold(self):
+        """Calls are refused after enough failures in a row."""
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.failure()
+        assert breaker.allow() is True
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.allow() is False
+
+    def test_half_open_lets_one_trial_through(self):
+        """After the reset timeout one call may try Revive again."""
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.failure()
+        assert breaker.allow() is True
+        assert breaker.allow() is False
+        breaker.success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+
+class TestResilience:
+    """Revive client when Revive misbehaves."""
+
+    def test_fails_fast_when_open(self, app, fake_revive):
+        """An open breaker stops calls before they reach Revive."""
+        for _ in range(revive.breaker.threshold):
+            revive.breaker.failure()
+        calls = len(fake_revive.calls)
+        with pytest.raises(ReviveUnavailable):
+            revive.ox.getAgency(1)
+        assert len(fake_revive.calls) == calls
+
+    def test_trial_not_lost_on_busy_pool(self, app, fake_revive):
+        """A trial call finding no free connection lets the next one try."""
+        app.config.update(REVIVE_POOL_SIZE=1, REVIVE_POOL_WAIT=0.01)
+        revive.sessionid()
+        revive.breaker.reset_timeout = 0
+        for _ in range(revive.breaker.threshold):
+            revive.breaker.failure()
+        held = revive.pool.acquire()
+        with pytest.raises(PoolExhausted):
+            revive.ox.getAgency(1)
+        revive.pool.release(held)
+        assert revive.ox.getAgency(1)
+        assert revive.breaker.state == CircuitBreaker.CLOSED
+
+    def test_serves_stale_reads(self, app, fake_revive):
+        """Reads give their last result while Revive is unreachable."""
+        publishers = revive.ox.getPublisherListByAgencyId(1)
+        for _ in range(revive.breaker.threshold):
+            revive.breaker.failure()
+        assert revive.ox.getPublisherListByAgencyId(1) == publishers
+
+    def test_timeout(self, app, fake_revive):
+        """A hung Revive does not block the caller for long."""
+        app.config['REVIVE_RETRIES'] = 0
+        revive.sessionid()
+        fake_revive.latency = 0.5
+        with pytest.raises(socket.timeout):
+            revive.call('ox.getAgency', revive.sessionid(), 1, timeout=0.1)
+
+
+@pytest.fixture
+def advertiser(db):
+    """A user which is not an advertiser in Revive yet."""
+    return User.create(username='advertiser', email='advertiser@example.com')
+
+
+class TestAdvertisers:
+    """Revive advertisers of our users."""
+
+    def test_provisioned_once(self, advertiser, fake_revive):
+        """A new user is registered in Revive only on the first call."""
+        advertiser_id = provision_advertiser(advertiser)
+        assert advertiser.revive_advertiser_id == advertiser_id
+        assert provision_advertiser(advertiser) == advertiser_id
+        assert fake_revive.calls.count('ox.addAdvertiser') == 1
+        assert fake_revive.calls.count('ox.getAdvertiserListByAgencyId') == 1
+
+    def test_backfill(self, advertiser, fake_revive):
+        """Users known to Revive get their advertiser ID stored."""
+        advertiser_id = fake_revive.addAdvertiser({'agencyId': 1, 'advertiserName': advertiser.username})
+        assert backfill_advertisers() == {'filled': 1, 'missing': 0}
+        assert advertiser.revive_advertiser_id == advertiser_id
+
+
+class TestInventory:
+    """Mirror of publishers and zones."""
+
+    def test_new_zones_get_prices(self, db, fake_revive):
+        """Zones mirrored on the first use are priced at once."""
+        zones = get_zones(all_sizes=True)
+        assert zones
+        assert all(price is not None and price.dayprice == 0 for zone, price in zones)
+
+    def test_zones_of_banner_size(self, db, fake_revive):
+        """Only zones of the banner size are listed, none for a banner without a size."""
+        zones = get_zones(width=468, height=60)
+        assert zones
+        assert all((zone.width, zone.height) == (468, 60) for zone, price in zones)
+        assert get_zones() == []
+
+
+class TestCampaignStats:
+    """Incremental sync of campaign impressions."""
+
+    @staticmethod
+    def order(campaigno, now):
+        return OrderFactory(campaigno=campaigno, begins_at=now - timedelta(days=5),
+                            stops_at=now + timedelta(days=5), paymentno=1)
+
+    def test_sync(self, db, fake_revive):
+        """Only recent days are asked for and old ones are kept."""
+        now = datetime.utcnow().replace(microsecond=0)
+        campaign_id = fake_revive.addCampaign({'advertiserId': fake_revive.addAdvertiser({})})
+        fake_revive.add_traffic(campaign_id, 100, when=now - timedelta(days=3))
+        fake_revive.add_traffic(campaign_id, 10, when=now)
+        order = self.order(campaign_id, now)
+        self.order(999, now)
+
+        assert sync_campaign_stats(now) == {'updated': 1, 'failed': 1}
+        assert (order.impressions, order.impressions_closed) == (110, 100)
+        assert order.stats_day == (now - timedelta(days=1)).date()
+
+        fake_revive.add_traffic(campaign_id, 5, when=now)
+        fake_revive.stats = [row for row in fake_revive.stats if row[0] >= now - timedelta(days=1)]
+        sync_campaign_stats(now)
+        assert order.impressions == 115
+
+    def test_zone_stats(self, db, fake_revive):
+        """Zone totals are stored and today's ones go to the hourly facts."""
+        now = datetime.utcnow().replace(microsecond=0)
+        campaign_id = fake_revive.addCampaign({'advertiserId': fake_revive.addAdvertiser({})})
+        fake_revive.linkCampaign(1, campaign_id)
+        fake_revive.add_traffic(campaign_id, 40, clicks=2, when=now)
+
+        assert sync_zone_stats(now) == 1
+        assert Impressions.query.filter_by(zoneid=1).one().impressions == 40
+        assert series(StatsFact.KIND_ZONE, 1, now, now, 'hour')[0]['impressions'] == 40
+
+
+class TestCleanup:
+    """Removal of unpaid orders."""
+
+    def test_removes_only_stale_unpaid(self, db, fake_revive):
+        """Paid and recent payments are kept, stale ones go in chunks."""
+        now = datetime.utcnow()
+        campaign_id = fake_revive.addCampaign({'advertiserId': fake_revive.addAdvertiser({})})
+        stale = [PaymentFactory(created_at=now - timedelta(days=10), received_at=datetime.min) for _ in range(3)]
+        recent = PaymentFactory(created_at=now, received_at=datetime.min)
+        paid = PaymentFactory(created_at=now - timedelta(days=10), received_at=now)
+        TestCampaignStats.order(campaign_id, now).update(paymentno=stale[0].id)
+
+        assert remove_unpaid(timeperiod=7, chunk=2) == {'payments': 3, 'campaigns': 1}
+        assert set(p.id for p in Payments.query) == {recent.id, paid.id}
+        assert campaign_id not in fake_revive.campaigns
+        assert Orders.query.count() == 0
+        assert Log.query.count() == 4
+
+    def test_removes_abandoned_baskets(self, db, fake_revive):
+        """Orders left in a basket for too long give their days back."""
+        now = datetime.utcnow()
+        campaign_id = fake_revive.addCampaign({'advertiserId': fake_revive.addAdvertiser({})})
+        abandoned = OrderFactory(campaigno=campaign_id, created_at=now - timedelta(days=10),
+                                 begins_at=now, stops_at=now + timedelta(days=3), paymentno=0)
+        Basket.create(user_id=1, campaigno=abandoned.campaigno)
+        recent = OrderFactory(campaigno=campaign_id + 1, zoneid=2, begins_at=now, paymentno=0)
+        assert not is_free(1, now, now)
+
+        assert remove_unpaid(timeperiod=7) == {'payments': 0, 'campaigns': 1}
+        assert is_free(1, now, now + timedelta(days=3))
+        assert campaign_id not in fake_revive.campaigns
+        assert [order.campaigno for order in Orders.query] == [recent.campaigno]
+        assert Basket.query.count() == 0
+
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Scheduler tests."""
+from beton.scheduling import LeaderLock, job_status, monitored
+
+
+class TestLeaderLock:
+    """Lock file choosing the process which runs the jobs."""
+
+    def test_only_one_leader(self, tmpdir):
+        """The lock is held by one holder until it is released."""
+        path = str(tmpdir.join('data', 'scheduler.lock'))
+        leader, follower = LeaderLock(path), LeaderLock(path)
+        assert leader.acquire() is True
+        assert follower.acquire() is False
+        leader.release()
+        assert follower.acquire() is True
+        assert follower.held
+
+
+class TestMonitored:
+    """Recording runs of scheduled jobs."""
+
+    def test_records_runs(self, db):
+        """Counts and errors of every run are stored."""
+        @monitored
+        def good_job():
+            return {'updated': 3, 'zones': 2, 'failed': 1}
+
+        @monitored
+        def bad_job():
+            raise RuntimeError('Revive is down')
+
+        good_job()
+        bad_job()
+        status = job_status()
+        assert status['good_job']['last_day']['items'] == 5
+        assert status['good_job']['runs'][0]['errors'] == 1
+        assert status['bad_job']['runs'][0]['errors'] == 1
+        assert 'Revive is down' in status['bad_job']['runs'][0]['details']